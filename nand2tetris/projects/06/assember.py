@@ -1,7 +1,71 @@
 from enum import Enum
+from array import array
+import time
 import sys
 import os
 
+from content_cache import ContentCache
+# 进程池、缓存与批量汇编用到的模块在使用处导入，单文件汇编不加载它们，保持启动内存与原脚本相当
+
+
+# 编码规则或缓存格式变化时需要修改，使旧的缓存失效
+ASSEMBLER_VERSION='4'
+# 缓存条目JSON头中保存的字段，其后为小端uint16机器码
+ASSEMBLY_CACHE_FIELDS=['symbol_map','labels']
+
+
+def to_binary(machine_code:int)->str:
+    '''
+    16位机器码 -> .hack 中的一行文本
+    '''
+    return format(machine_code,'016b')
+
+def pack_machine_codes(machine_codes:array)->bytes:
+    '''
+    按小端uint16打包机器码，即.hackb文件内容
+    '''
+    if sys.byteorder == 'little':
+        return machine_codes.tobytes()
+    swapped=array('H',machine_codes)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+def unpack_machine_codes(data:bytes)->array:
+    '''
+    pack_machine_codes 的逆操作
+    '''
+    machine_codes=array('H')
+    machine_codes.frombytes(data)
+    if sys.byteorder == 'big':
+        machine_codes.byteswap()
+    return machine_codes
+
+def save_symbol_file(file_path:str,table:dict,labels:set):
+    '''
+    写出符号表，每行为 种类 名称 地址，种类为 label 或 variable，预定义符号不写出
+    '''
+    predefined=SymbolTable().table
+    with open(file_path,'w') as f:
+        for symbol,address in sorted(table.items(),key=lambda item:(item[1],item[0])):
+            if symbol in labels:
+                f.write('label '+symbol+' '+str(address)+'\n')
+            elif predefined.get(symbol) != address:
+                f.write('variable '+symbol+' '+str(address)+'\n')
+
+def clean_line(assembler_code:str)->str:
+    '''
+    去掉空白、空行与注释，返回空串表示该行无需处理
+    '''
+    # 去掉首尾空格
+    assembler_code=assembler_code.strip()
+    # 去掉空行与注释
+    if assembler_code == '' or assembler_code.startswith('/'):
+        return ''
+    # 去掉行注释
+    if assembler_code.find('/') !=-1:
+        assembler_code=assembler_code[:assembler_code.find('/')]
+    return assembler_code.strip()
+
 
 class SymbolTable:
     def  __init__(self) -> None:
@@ -33,8 +97,10 @@ class SymbolTable:
             "KBD":24576,
         }
         self.alloc_address=16
+        self.labels=set()
     def addLabel(self,symbol:str,address:int):
         self.table[symbol]=address
+        self.labels.add(symbol)
     def addEntry(self,symbol:str)->int:
         self.table[symbol]=self.alloc_address
         self.alloc_address+=1
@@ -48,7 +114,10 @@ class CodeTranslator:
     '''
     Translate Hash assembler code to machine code
     '''
-    def __init__(self,symbol_table:SymbolTable) -> None:
+    # 各实例共用的C指令表，首次构造时生成
+    shared_c_command_table=None
+    def __init__(self,symbol_table:SymbolTable,verbose:bool=True) -> None:
+        self.verbose=verbose
         self.dest_map={
             'NULL':'000',
             'M':'001',
@@ -108,88 +177,112 @@ class CodeTranslator:
 
             'D|A':'0010101',
             'D|M':'1010101',
+
+            # 可交换运算的另一种写法，VM翻译器会生成如 A=M+D 的指令
+            'A+D':'0000010',
+            'M+D':'1000010',
+            'A&D':'0000000',
+            'M&D':'1000000',
+            'A|D':'0010101',
+            'M|D':'1010101',
         }
+        # 预先把各字段换算成整数并移到所在的位上
+        self.dest_code={k:int(v,2)<<3 for k,v in self.dest_map.items()}
+        self.jump_code={k:int(v,2) for k,v in self.jump_map.items()}
+        self.comp_code={k:int(v,2)<<6 for k,v in self.comp_map.items()}
+        # 所有合法 dest=comp;jump 组合的机器码
+        if CodeTranslator.shared_c_command_table is None:
+            CodeTranslator.shared_c_command_table=self.build_c_command_table()
+        self.c_command_table=CodeTranslator.shared_c_command_table
+        # 指令文本 -> 机器码，每条不同的指令只编码一次
+        self.cache={}
+        self.cache_hits=0
+        self.cache_misses=0
         self.symbol_table=symbol_table
+    def build_c_command_table(self)->dict:
+        table={}
+        for comp,comp_code in self.comp_code.items():
+            for dest,dest_code in self.dest_code.items():
+                for jump,jump_code in self.jump_code.items():
+                    code=comp
+                    if dest != 'NULL':
+                        code=dest+'='+code
+                    if jump != 'NULL':
+                        code=code+';'+jump
+                    table[code]=0xE000|comp_code|dest_code|jump_code
+        return table
+    def cache_hit_rate(self)->float:
+        total=self.cache_hits+self.cache_misses
+        if total == 0:
+            return 0.0
+        return self.cache_hits/total
     def dest(self,dest:str)->str:
         return self.dest_map[dest]
     def comp(self,comp:str)->str:
         return self.comp_map[comp]
     def jump(self,jump:str)->str:
         return self.jump_map[jump]
-    def translate(self,code:str)->str:
+    def translate(self,code:str)->int:
         if code.startswith('('): # L Command
             return
-        elif code.startswith('@'): # A Command
-            print('ACommand:',code)
-            code=code[1:].strip()
-            if code.isdecimal():
-                binary=bin(int(code))[2:]
-                binary="0"*(16-len(binary))+binary
-                print('->Machine Code:',binary)
-                return binary
-            elif self.symbol_table.contains(code) == None:
-                print('add ' + code + ' to symbol table')
-                address =self.symbol_table.addEntry(code)
-                binary=bin(int(address))[2:]
-                binary="0"*(16-len(binary))+binary
-                print('->Machine Code:',binary)
-                return binary
+        machine_code=self.cache.get(code)
+        if machine_code is not None:
+            self.cache_hits+=1
+            if self.verbose:
+                print(code,'->Machine Code:',to_binary(machine_code))
+            return machine_code
+        self.cache_misses+=1
+        if code.startswith('@'): # A Command
+            if self.verbose:
+                print('ACommand:',code)
+            symbol=code[1:].strip()
+            if symbol.isdecimal():
+                machine_code=int(symbol)
+            elif self.symbol_table.contains(symbol) == None:
+                if self.verbose:
+                    print('add ' + symbol + ' to symbol table')
+                machine_code=self.symbol_table.addEntry(symbol)
             else:
-                assert self.symbol_table.contains(code) != None
-                address = self.symbol_table.getAddress(code)
-                binary=bin(int(address))[2:]
-                binary = "0"*(16-len(binary))+binary
-                print('->Machine Code:',binary)
-                return binary
+                machine_code=self.symbol_table.getAddress(symbol)
+            assert machine_code < 0x8000,'A指令地址越界'+code
         else: # C Command
-            print('CCommand:',code)
-            equal_loc = code.find('=')
-            semicolon_loc = code.find(';')
-            dest=''
-            comp=''
-            jump=''
-            if equal_loc == -1:
-                dest='NULL'
-            if semicolon_loc == -1:
-                jump='NULL'
-                semicolon_loc=len(code)
-            if len(dest) == 0:
-                dest = code[:equal_loc]
-            if len(jump) == 0:
-                jump = code[semicolon_loc+1:]
-            comp = code[equal_loc+1:semicolon_loc]
-            binary = '111'+self.comp_map[comp]+self.dest_map[dest]+self.jump_map[jump]
-            print('->Machine Code:',binary)
-            return binary
+            if self.verbose:
+                print('CCommand:',code)
+            machine_code=self.c_command_table.get(code)
+            assert machine_code != None,'非法C指令'+code
+        if self.verbose:
+            print('->Machine Code:',to_binary(machine_code))
+        # 符号一旦分配地址就不再变化，A指令同样可以缓存
+        self.cache[code]=machine_code
+        return machine_code
 
 
 class Parser:
     '''
     A simple parser for Hach assembler
     '''
-    def __init__(self,file_path:str) -> None:
+    def __init__(self,file_path:str=None) -> None:
+        '''
+        file_path 为空时不读文件，由调用者通过 load 传入源码行
+        '''
+        self.assembler_codes=[]
+        self.cursor=-1
+        self.symbol_table=SymbolTable()
+        if file_path is None:
+            return
         self.file_name=os.path.basename(file_path)
         suffix=self.file_name[-3:]
         assert suffix=='asm','please input an file named like Xxx.asm'
-
-        self.assembler_codes=[]
-        self.cursor=-1
         with open(file_path,'r') as f:
-            for assembler_code in f:
-                # 去掉首尾空格
-                assembler_code=assembler_code.strip()
-                # 去掉空行
-                if assembler_code.strip() == '':
-                    continue
-                # 去掉注释
-                if assembler_code.startswith('/'):
-                    continue
-                # 去掉行注释
-                if assembler_code.find('/') !=-1:
-                    assembler_code=assembler_code[:assembler_code.find('/')]
-                self.assembler_codes.append(assembler_code.strip())    
-        self.symbol_table=SymbolTable()
-        
+            self.load(f)
+
+    def load(self,lines):
+        for assembler_code in lines:
+            assembler_code=clean_line(assembler_code)
+            if assembler_code == '':
+                continue
+            self.assembler_codes.append(assembler_code)
+
     def hasMoreCommands(self)->bool:
         return self.cursor < len(self.assembler_codes)
     
@@ -208,34 +301,707 @@ class Parser:
                 filted_codes.append(code)
                 cursor+=1
         self.assembler_codes=filted_codes
+    def optimize(self,optimizers:list):
+        '''
+        在 pre_process 之后调用：按地址把标签插回指令序列，
+        依次交给各个优化器改写，再重新计算标签地址
+        优化器会删除指令，要求跳转目标都以符号给出
+        '''
+        if len(optimizers) == 0:
+            return
+        labels_at={}
+        for label in sorted(self.symbol_table.labels):
+            labels_at.setdefault(self.symbol_table.getAddress(label),[]).append(label)
+        codes=[]
+        for address,code in enumerate(self.assembler_codes):
+            codes.extend('('+label+')' for label in labels_at.get(address,[]))
+            codes.append(code)
+        codes.extend('('+label+')' for label in labels_at.get(len(self.assembler_codes),[]))
+        if has_absolute_jump(codes):
+            print('存在以数字地址给出的跳转目标，删除指令会使其失效，跳过优化')
+            return
+        for optimizer in optimizers:
+            codes=optimizer.run(codes)
+        self.assembler_codes=codes
+        self.pre_process()
+
+def split_c_command(code:str)->tuple:
+    '''
+    C指令 -> (dest, comp, jump)，省略的部分为空串
+    '''
+    dest,comp,jump='',code,''
+    if comp.find('=') != -1:
+        dest,comp=comp.split('=',1)
+    if comp.find(';') != -1:
+        comp,jump=comp.split(';',1)
+    return dest,comp,jump
+
+def is_jump_command(code:str)->bool:
+    return not code.startswith(('@','(')) and code.find(';') != -1
+
+def has_absolute_jump(codes:list)->bool:
+    for i in range(1,len(codes)):
+        if is_jump_command(codes[i]) and codes[i-1][1:].isdecimal():
+            return True
+    return False
+
+class PeepholeOptimizer:
+    '''
+    汇编级窥孔优化：在不跨越标签的窗口内反复应用保持语义的改写规则，直到不再变化
+    标签地址由 Parser.optimize 在改写后重新计算，它负责检查跳转目标都以符号给出
+    '''
+    def __init__(self) -> None:
+        # 规则名 -> 匹配函数，返回 (匹配的指令数, 替换后的指令列表) 或 None
+        self.rules=[
+            ('dead_a_load',self.dead_a_load),
+            ('redundant_a_reload',self.redundant_a_reload),
+            ('redundant_store',self.redundant_store),
+            ('inc_dec_cancel',self.inc_dec_cancel),
+            ('dead_d_write',self.dead_d_write),
+        ]
+        # 规则名 -> 删除的指令数
+        self.removed={name:0 for name,_ in self.rules}
+    def run(self,codes:list)->list:
+        changed=True
+        while changed:
+            changed=False
+            optimized=[]
+            i=0
+            while i < len(codes):
+                for name,rule in self.rules:
+                    matched=rule(codes,i)
+                    if matched is not None:
+                        length,replacement=matched
+                        optimized.extend(replacement)
+                        self.removed[name]+=length-len(replacement)
+                        i+=length
+                        changed=True
+                        break
+                else:
+                    optimized.append(codes[i])
+                    i+=1
+            codes=optimized
+        return codes
+    def report(self)->str:
+        lines=['%-20s %6d' % (name,count) for name,count in self.removed.items()]
+        lines.append('%-20s %6d' % ('total',sum(self.removed.values())))
+        return '\n'.join(lines)
+    def is_c_command(self,codes:list,i:int)->bool:
+        return i < len(codes) and not codes[i].startswith(('@','('))
+    # @X @Y -> @Y
+    def dead_a_load(self,codes:list,i:int):
+        if codes[i].startswith('@') and i+1 < len(codes) and codes[i+1].startswith('@'):
+            return 1,[]
+        return None
+    # @X ...(不写A，无跳转)... @X -> 去掉第二个 @X
+    def redundant_a_reload(self,codes:list,i:int):
+        if not codes[i].startswith('@'):
+            return None
+        j=i+1
+        while self.is_c_command(codes,j):
+            dest,_,jump=split_c_command(codes[j])
+            if 'A' in dest or jump != '':
+                return None
+            j+=1
+        if j < len(codes) and j > i+1 and codes[j] == codes[i]:
+            return j-i+1,codes[i:j]
+        return None
+    # D=M M=D -> D=M，M=D D=M -> M=D（A不变，内存与D已相等）
+    def redundant_store(self,codes:list,i:int):
+        if self.is_c_command(codes,i+1) and (codes[i],codes[i+1]) in [('D=M','M=D'),('M=D','D=M')]:
+            return 2,[codes[i]]
+        return None
+    # M=M+1 AM=M-1 -> A=M，M=M+1 M=M-1 -> 无
+    def inc_dec_cancel(self,codes:list,i:int):
+        if not self.is_c_command(codes,i+1):
+            return None
+        pair=(codes[i],codes[i+1])
+        if pair == ('M=M+1','AM=M-1'):
+            return 2,['A=M']
+        if pair in [('M=M+1','M=M-1'),('M=M-1','M=M+1')]:
+            return 2,[]
+        return None
+    # D=x 后紧跟不读D而写D的指令 -> 第一条是死写
+    def dead_d_write(self,codes:list,i:int):
+        if not (self.is_c_command(codes,i) and self.is_c_command(codes,i+1)):
+            return None
+        dest,_,jump=split_c_command(codes[i])
+        next_dest,next_comp,_=split_c_command(codes[i+1])
+        if dest == 'D' and jump == '' and 'D' in next_dest and 'D' not in next_comp:
+            return 1,[]
+        return None
+
+class ControlFlowOptimizer:
+    '''
+    基于标签的控制流优化：
+    1. 跳转串联：目标处只有 @M 0;JMP 时直接跳到最终目标，改写的A值在跳转后不再被读取
+    2. 删除不可达指令：从程序入口与所有被当作数据取地址的标签出发，沿顺序执行与直接跳转可达
+    3. 删除跳到紧随其后标签的跳转
+    与窥孔优化相同，由 Parser.optimize 检查跳转目标都以符号给出
+    '''
+    def __init__(self) -> None:
+        self.threaded=0
+        self.removed={'unreachable':0,'jump_to_next':0}
+    def run(self,codes:list)->list:
+        changed=True
+        while changed:
+            count=self.threaded+sum(self.removed.values())
+            codes=self.thread_jumps(codes)
+            codes=self.remove_unreachable(codes)
+            codes=self.remove_jump_to_next(codes)
+            changed=self.threaded+sum(self.removed.values()) != count
+        return codes
+    def report(self)->str:
+        lines=['%-20s %6d' % (name,count) for name,count in self.removed.items()]
+        lines.append('%-20s %6d' % ('threaded_jumps',self.threaded))
+        return '\n'.join(lines)
+    def label_positions(self,codes:list)->dict:
+        '''
+        标签 -> 其后第一条指令在 codes 中的下标，程序末尾的标签为 len(codes)
+        '''
+        positions={}
+        pending=[]
+        for i,code in enumerate(codes):
+            if code.startswith('('):
+                pending.append(code[1:-1])
+                continue
+            for label in pending:
+                positions[label]=i
+            pending=[]
+        for label in pending:
+            positions[label]=len(codes)
+        return positions
+    def thread_jumps(self,codes:list)->list:
+        positions=self.label_positions(codes)
+        # 只含 @M 0;JMP 的跳板标签 -> M
+        trampolines={}
+        for label,i in positions.items():
+            if i+1 < len(codes) and codes[i].startswith('@') and codes[i+1] == '0;JMP' \
+                    and codes[i][1:] in positions:
+                trampolines[label]=codes[i][1:]
+        codes=list(codes)
+        for i in range(len(codes)-1):
+            if not (codes[i].startswith('@') and is_jump_command(codes[i+1])):
+                continue
+            # 改写后A的值变为最终目标：跳转指令本身不能读写A/M，
+            # 条件跳转不成立时顺序执行的下一条指令须重新装入A
+            dest,comp,jump=split_c_command(codes[i+1])
+            if dest != '' or 'A' in comp or 'M' in comp:
+                continue
+            if jump != 'JMP':
+                j=i+2
+                while j < len(codes) and codes[j].startswith('('):
+                    j+=1
+                if not (j < len(codes) and codes[j].startswith('@')):
+                    continue
+            label=codes[i][1:]
+            target=label
+            visited=set()
+            while target in trampolines and target not in visited:
+                visited.add(target)
+                target=trampolines[target]
+            if target != label and target not in visited:
+                codes[i]='@'+target
+                self.threaded+=1
+        return codes
+    def remove_unreachable(self,codes:list)->list:
+        positions=self.label_positions(codes)
+        # 被当作数据装入的标签（如返回地址）可能经由间接跳转到达
+        roots=[0]
+        for i,code in enumerate(codes):
+            if code.startswith('@') and code[1:] in positions \
+                    and not (i+1 < len(codes) and is_jump_command(codes[i+1])):
+                roots.append(positions[code[1:]])
+        reachable=set()
+        previous_a_command={}
+        last=None
+        for i,code in enumerate(codes):
+            if code.startswith('('):
+                continue
+            previous_a_command[i]=last
+            last=code if code.startswith('@') else None
+        while roots:
+            i=roots.pop()
+            while i < len(codes) and i not in reachable:
+                if codes[i].startswith('('):
+                    i+=1
+                    continue
+                reachable.add(i)
+                if is_jump_command(codes[i]):
+                    target=previous_a_command[i]
+                    if target is not None and target[1:] in positions:
+                        roots.append(positions[target[1:]])
+                    if codes[i].endswith(';JMP'):
+                        break
+                i+=1
+        optimized=[]
+        for i,code in enumerate(codes):
+            if code.startswith('(') or i in reachable:
+                optimized.append(code)
+            else:
+                self.removed['unreachable']+=1
+        return optimized
+    def remove_jump_to_next(self,codes:list)->list:
+        optimized=[]
+        i=0
+        while i < len(codes):
+            if i+1 < len(codes) and codes[i].startswith('@') and is_jump_command(codes[i+1]) \
+                    and split_c_command(codes[i+1])[0] == '':
+                labels=[]
+                j=i+2
+                while j < len(codes) and codes[j].startswith('('):
+                    labels.append(codes[j][1:-1])
+                    j+=1
+                # 跳转目标处会重新装入A，省去跳转后A的值不同也无影响
+                if codes[i][1:] in labels and j < len(codes) and codes[j].startswith('@'):
+                    self.removed['jump_to_next']+=2
+                    i+=2
+                    continue
+            optimized.append(codes[i])
+            i+=1
+        return optimized
+
+# 并行汇编时每个工作进程各自持有的翻译器，只含预定义符号
+worker_translator=None
+
+def split_source(file_path:str,chunk_bytes:int)->list:
+    '''
+    按字节把源文件分为若干区间 [(起点, 终点)]，区间边界不必对齐行
+    '''
+    size=os.path.getsize(file_path)
+    return [(start,min(start+chunk_bytes,size)) for start in range(0,size,chunk_bytes)]
+
+def read_chunk_lines(file_path:str,start:int,end:int):
+    '''
+    逐行产生起始字节位于 [start, end) 的源码行，跨越边界的行归属它开始的区间
+    '''
+    with open(file_path,'rb') as f:
+        if start > 0:
+            # 跳过上一个区间开始的行的剩余部分
+            f.seek(start-1)
+            f.readline()
+        while f.tell() < end:
+            line=f.readline()
+            if line == b'':
+                break
+            yield line.decode()
+
+def parse_chunk(file_path:str,start:int,end:int,keep_codes:bool=False)->tuple:
+    '''
+    并行汇编的工作进程：读取并清理一段源码，记录标签，编码不依赖用户符号的指令
+    返回 (机器码, [(标签, 段内地址)], [(段内地址, 符号)], 指令与标签列表或None, 编码缓存命中数, 未命中数)，
+    符号引用处的机器码暂填0；keep_codes 时只清理源码并返回指令与标签列表，供优化后再编码
+    '''
+    global worker_translator
+    codes=[]
+    for line in read_chunk_lines(file_path,start,end):
+        code=clean_line(line)
+        if code != '':
+            codes.append(code)
+    if keep_codes:
+        return None,[],[],codes,0,0
+    if worker_translator is None:
+        worker_translator=CodeTranslator(SymbolTable(),False)
+    predefined=worker_translator.symbol_table.table
+    translate=worker_translator.translate
+    hits=worker_translator.cache_hits
+    misses=worker_translator.cache_misses
+    machine_codes=array('H')
+    labels=[]
+    references=[]
+    for code in codes:
+        if code.startswith('('): # L Command
+            labels.append((code[1:-1],len(machine_codes)))
+            continue
+        if code.startswith('@'):
+            symbol=code[1:].strip()
+            if not symbol.isdecimal() and symbol not in predefined:
+                references.append((len(machine_codes),symbol))
+                machine_codes.append(0)
+                continue
+        machine_codes.append(translate(code))
+    return (machine_codes,labels,references,None,
+            worker_translator.cache_hits-hits,worker_translator.cache_misses-misses)
+
+class AssemblyCache(ContentCache):
+    '''
+    以源码内容与汇编器版本的哈希为键，缓存机器码与符号表
+    条目为一行JSON（符号表与标签）加小端uint16机器码
+    '''
+    def key(self,source:bytes,options:str='')->str:
+        '''
+        options 为影响输出的汇编选项，不同选项的结果分开缓存
+        '''
+        return super().key(ASSEMBLER_VERSION,options,source)
+    def get(self,key:str):
+        '''
+        命中时返回 (机器码, 符号表, 标签集合)，否则返回None
+        '''
+        import json
+        data=super().get(key)
+        if data is None:
+            return None
+        header,_,code=data.partition(b'\n')
+        try:
+            entry=json.loads(header)
+        except ValueError:
+            return None
+        if not isinstance(entry,dict) or set(entry) != set(ASSEMBLY_CACHE_FIELDS) or len(code) % 2 != 0:
+            return None
+        return unpack_machine_codes(code),entry['symbol_map'],set(entry['labels'])
+    def put(self,key:str,machine_codes:array,symbol_map:dict,labels:set):
+        import json
+        header=json.dumps({'symbol_map':symbol_map,'labels':sorted(labels)}).encode()
+        super().put(key,header+b'\n'+pack_machine_codes(machine_codes))
+
 class Assembler:
-    def __init__(self,file_path:str) -> None:
+    def __init__(self,file_path:str,verbose:bool=True,cache:AssemblyCache=None,optimize:bool=False) -> None:
         '''
         A simple assembler for Hack machine
+        源码在 run 中读取，run_parallel 由工作进程分段读取
         '''
-        self.parser = Parser(file_path)
-        self.machine_codes=[]
-        self.save_file_path = file_path[:-4]+'.hack'        
+        self.file_path=file_path
+        self.parser=None
+        self.machine_codes=array('H')
+        self.symbol_map=None
+        self.labels=None
+        self.save_file_path = file_path[:-4]+'.hack'
+        self.save_binary_file_path = file_path[:-4]+'.hackb'
+        self.save_symbol_file_path = file_path[:-4]+'.sym'
+        self.verbose=verbose
+        self.translator=None
+        # 可选的控制流优化与窥孔优化，在 pre_process 之后、编码之前依次执行
+        self.optimizers=[ControlFlowOptimizer(),PeepholeOptimizer()] if optimize else []
+        self.cache=cache
+        self.cache_key=None
+        self.cache_hit=False
+        if cache is not None:
+            with open(file_path,'rb') as f:
+                self.cache_key=cache.key(f.read(),'optimize' if optimize else '')
+            entry=cache.get(self.cache_key)
+            if entry is not None:
+                # 命中时跳过解析与编码
+                self.machine_codes,self.symbol_map,self.labels=entry
+                self.cache_hit=True
+    def store_cache(self):
+        self.symbol_map=dict(self.parser.symbol_table.table)
+        self.labels=set(self.parser.symbol_table.labels)
+        if self.cache is not None:
+            self.cache.put(self.cache_key,self.machine_codes,self.symbol_map,self.labels)
     def run(self):
-        translator=CodeTranslator(self.parser.symbol_table)
+        if self.cache_hit:
+            return
+        self.parser = Parser(self.file_path)
+        translator=CodeTranslator(self.parser.symbol_table,self.verbose)
+        self.translator=translator
         self.parser.pre_process()
+        if len(self.optimizers) > 0:
+            self.parser.optimize(self.optimizers)
         while True:
             code = self.parser.advance()
-            print(code)
+            if self.verbose:
+                print(code)
             if code == '':
                 break
             machine_code = translator.translate(code)
             assert machine_code  !=None,'翻译错误'+code
             self.machine_codes.append(machine_code)
+        self.store_cache()
+    def run_parallel(self,workers:int=None,chunk_bytes:int=256*1024):
+        '''
+        按字节区间分段，工作进程各自读取、清理、解析并编码一段源码；
+        主进程按顺序拼接，依次登记各段标签，最后按首次出现的顺序解析符号引用、分配变量，
+        结果与 run 完全一致。优化需要完整的指令序列，此时只并行读取与清理
+        '''
+        if self.cache_hit:
+            return
+        ranges=split_source(self.file_path,chunk_bytes)
+        if len(ranges) <= 1 or workers == 1:
+            # 代码太少，不值得启动进程池
+            self.run()
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        keep_codes=len(self.optimizers) > 0
+        self.parser=Parser()
+        symbol_table=self.parser.symbol_table
+        self.translator=CodeTranslator(symbol_table,False)
+        # [(段起始地址, 段内符号引用)]
+        references=[]
+        with ProcessPoolExecutor(workers) as executor:
+            results=executor.map(parse_chunk,[self.file_path]*len(ranges),[start for start,_ in ranges],
+                                 [end for _,end in ranges],[keep_codes]*len(ranges))
+            for machine_codes,labels,chunk_references,codes,hits,misses in results:
+                self.translator.cache_hits+=hits
+                self.translator.cache_misses+=misses
+                if keep_codes:
+                    self.parser.assembler_codes.extend(codes)
+                    continue
+                base=len(self.machine_codes)
+                for label,address in labels:
+                    symbol_table.addLabel(label,base+address)
+                self.machine_codes.extend(machine_codes)
+                references.append((base,chunk_references))
+        if keep_codes:
+            self.parser.pre_process()
+            self.parser.optimize(self.optimizers)
+            self.machine_codes=array('H',map(self.translator.translate,self.parser.assembler_codes))
+        else:
+            for base,chunk_references in references:
+                for position,symbol in chunk_references:
+                    address=symbol_table.getAddress(symbol)
+                    if address is None:
+                        address=symbol_table.addEntry(symbol)
+                    assert address < 0x8000,'A指令地址越界@'+symbol
+                    self.machine_codes[base+position]=address
+        self.store_cache()
     def save(self):
         with open(self.save_file_path,'w') as f:
-            for line in self.machine_codes:
-                f.write(line)
+            for machine_code in self.machine_codes:
+                f.write(to_binary(machine_code))
                 f.write('\n')
-        
-if __name__== '__main__':
-    file_path = sys.argv[1]
-    assembler = Assembler(file_path)
-    assembler.run()
+    def save_binary(self):
+        # 小端uint16紧凑格式，可直接用 array.frombytes / numpy.fromfile 载入
+        with open(self.save_binary_file_path,'wb') as f:
+            f.write(pack_machine_codes(self.machine_codes))
+    def save_symbols(self):
+        # 供反汇编器标注标签使用
+        save_symbol_file(self.save_symbol_file_path,self.symbol_map,self.labels)
+
+def assemble(source,optimize:bool=False)->tuple:
+    '''
+    在内存中汇编，不读写任何文件
+    source 为完整的汇编源码字符串，或逐行产生汇编代码的可迭代对象
+    返回 (机器码 array('H'), 解析后的符号表 dict)
+    '''
+    if isinstance(source,str):
+        source=source.splitlines()
+    parser=Parser()
+    parser.load(source)
+    parser.pre_process()
+    if optimize:
+        parser.optimize([ControlFlowOptimizer(),PeepholeOptimizer()])
+    translator=CodeTranslator(parser.symbol_table,False)
+    machine_codes=array('H',map(translator.translate,parser.assembler_codes))
+    return machine_codes,dict(parser.symbol_table.table)
+
+class StreamingAssembler:
+    '''
+    单遍流式汇编：逐行读取.asm并立即写出机器码，
+    遇到尚未定义的符号先写占位，读完后再回填（标签或新分配的变量）
+    output_format 为 both 时同一遍同时写出 .hack 与 .hackb
+    '''
+    def __init__(self,file_path:str,verbose:bool=True,output_format:str='hack') -> None:
+        file_name=os.path.basename(file_path)
+        assert file_name[-3:]=='asm','please input an file named like Xxx.asm'
+        assert output_format in ['hack','hackb','both']
+        self.file_path=file_path
+        # [(输出文件, 是否为小端uint16格式)]
+        self.outputs=[]
+        if output_format in ['hack','both']:
+            self.outputs.append((file_path[:-4]+'.hack',False))
+        if output_format in ['hackb','both']:
+            self.outputs.append((file_path[:-4]+'.hackb',True))
+        self.save_symbol_file_path = file_path[:-4]+'.sym'
+        self.symbol_table=SymbolTable()
+        self.verbose=verbose
+        # 未解析符号 -> 引用它的指令地址列表，按首次出现顺序保存
+        self.unresolved={}
+        self.instruction_count=0
+    def encode(self,machine_code:int,binary:bool)->bytes:
+        # 回填按固定的记录宽度定位，超过16位会破坏记录
+        assert 0 <= machine_code <= 0xFFFF,'机器码超过16位'+str(machine_code)
+        if binary:
+            return machine_code.to_bytes(2,'little')
+        return to_binary(machine_code).encode()+b'\n'
+    def record_width(self,binary:bool)->int:
+        # .hackb 每条机器码占一个小端uint16，.hack 占16位加一个换行符
+        return 2 if binary else 17
+    def run(self):
+        translator=CodeTranslator(self.symbol_table,self.verbose)
+        self.translator=translator
+        dsts=[]
+        try:
+            for path,binary in self.outputs:
+                dsts.append((open(path,'wb+'),binary))
+            placeholders=[(dst,self.encode(0,binary)) for dst,binary in dsts]
+            with open(self.file_path,'r') as src:
+                for code in src:
+                    code=clean_line(code)
+                    if code == '':
+                        continue
+                    if code.startswith('('): # L Command
+                        self.symbol_table.addLabel(code[1:-1],self.instruction_count)
+                        continue
+                    if code.startswith('@'):
+                        symbol=code[1:].strip()
+                        if not symbol.isdecimal() and self.symbol_table.contains(symbol) is None:
+                            # 可能是后面才定义的标签，也可能是变量，先占位
+                            self.unresolved.setdefault(symbol,[]).append(self.instruction_count)
+                            for dst,placeholder in placeholders:
+                                dst.write(placeholder)
+                            self.instruction_count+=1
+                            continue
+                    machine_code = translator.translate(code)
+                    assert machine_code != None,'翻译错误'+code
+                    for dst,binary in dsts:
+                        dst.write(self.encode(machine_code,binary))
+                    self.instruction_count+=1
+            for dst,binary in dsts:
+                self.backpatch(dst,binary)
+            self.unresolved={}
+        finally:
+            for dst,_ in dsts:
+                dst.close()
+    def backpatch(self,dst,binary:bool):
+        # 读完全部代码后仍未定义为标签的符号即为变量，按首次出现顺序分配地址
+        width=self.record_width(binary)
+        for symbol,locations in self.unresolved.items():
+            address=self.symbol_table.getAddress(symbol)
+            if address is None:
+                address=self.symbol_table.addEntry(symbol)
+            # 与两遍汇编的 CodeTranslator.translate 相同的检查，定义在32K之后的标签无法用A指令寻址
+            assert address < 0x8000,'A指令地址越界@'+symbol
+            record=self.encode(address,binary)
+            for location in locations:
+                dst.seek(location*width)
+                dst.write(record)
+    def save_symbols(self):
+        save_symbol_file(self.save_symbol_file_path,self.symbol_table.table,self.symbol_table.labels)
+
+def assemble_file(file_path:str,verbose:bool=True,stream:bool=False,output_format:str='hack',jobs:int=0,
+                  cache:AssemblyCache=None,symbols:bool=False,optimize:bool=False):
+    '''
+    汇编单个.asm文件并按 output_format 写出结果，返回所用的汇编器
+    流式汇编只读一遍源码，不经过缓存也不做优化
+    '''
+    if stream:
+        assembler = StreamingAssembler(file_path,verbose,output_format)
+        assembler.run()
+        if symbols:
+            assembler.save_symbols()
+        return assembler
+    assembler = Assembler(file_path,verbose,cache,optimize)
+    if jobs > 1:
+        assembler.run_parallel(jobs)
+    else:
+        assembler.run()
     # print(assembler.machine_codes)
-    assembler.save()
\ No newline at end of file
+    if output_format in ['hack','both']:
+        assembler.save()
+    if output_format in ['hackb','both']:
+        assembler.save_binary()
+    if symbols:
+        assembler.save_symbols()
+    return assembler
+
+def find_asm_files(paths:list)->list:
+    '''
+    展开目录（递归）与通配符，返回去重排序后的.asm文件列表
+    '''
+    import glob
+    file_paths=set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root,_,filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.endswith('.asm'):
+                        file_paths.add(os.path.join(root,filename))
+        elif glob.has_magic(path):
+            for filename in glob.glob(path,recursive=True):
+                if os.path.isdir(filename):
+                    file_paths.update(find_asm_files([filename]))
+                elif filename.endswith('.asm'):
+                    file_paths.add(filename)
+        else:
+            file_paths.add(path)
+    return sorted(file_paths)
+
+def batch_worker(file_path:str,cache_dir:str,cache_size:int,options:dict)->tuple:
+    start=time.perf_counter()
+    try:
+        cache=None
+        if cache_dir is not None:
+            cache=AssemblyCache(cache_dir,cache_size)
+        assembler=assemble_file(file_path,False,cache=cache,**options)
+    except Exception as e:
+        return file_path,0,time.perf_counter()-start,repr(e)
+    if options.get('stream'):
+        instruction_count=assembler.instruction_count
+    else:
+        instruction_count=len(assembler.machine_codes)
+    return file_path,instruction_count,time.perf_counter()-start,None
+
+def assemble_batch(file_paths:list,workers:int=None,cache_dir:str=None,cache_size:int=64*1024*1024,**options)->bool:
+    '''
+    用进程池并行汇编多个文件，逐个打印结果与耗时，全部成功时返回True
+    options 原样传给 assemble_file
+    '''
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    start=time.perf_counter()
+    results=[]
+    with ProcessPoolExecutor(workers) as executor:
+        futures=[executor.submit(batch_worker,file_path,cache_dir,cache_size,options) for file_path in file_paths]
+        for future in as_completed(futures):
+            file_path,instruction_count,seconds,error=future.result()
+            results.append((file_path,instruction_count,seconds,error))
+            if error is None:
+                print('%-60s %8d 条指令 %8.3fs' % (file_path,instruction_count,seconds))
+            else:
+                print('%-60s 失败 %s' % (file_path,error))
+    failed=[result for result in results if result[3] is not None]
+    print('共 %d 个文件，失败 %d 个，累计耗时 %.3fs，实际耗时 %.3fs' % (
+        len(results),len(failed),sum(result[2] for result in results),time.perf_counter()-start))
+    return len(failed) == 0
+
+def is_batch_input(file_paths:list)->bool:
+    '''
+    多个路径、目录或通配符时批量汇编；单个已存在的文件不需要导入glob
+    '''
+    if len(file_paths) > 1 or os.path.isdir(file_paths[0]):
+        return True
+    if os.path.isfile(file_paths[0]):
+        return False
+    import glob
+    return glob.has_magic(file_paths[0])
+
+if __name__== '__main__':
+    import argparse
+    arg_parser=argparse.ArgumentParser(description='Hack assembler')
+    arg_parser.add_argument('file_paths',nargs='+',help='Xxx.asm，或多个文件、目录、通配符进行批量汇编')
+    arg_parser.add_argument('--stream',action='store_true',help='单遍流式汇编，读取时即写出机器码，最后回填前向引用')
+    arg_parser.add_argument('--format',choices=['hack','hackb','both'],default='hack',
+                            help='输出文本.hack、小端uint16紧凑格式.hackb或两者')
+    arg_parser.add_argument('-O','--optimize',action='store_true',help='编码前进行控制流与窥孔优化，要求跳转目标均为符号')
+    arg_parser.add_argument('--symbols',action='store_true',help='同时写出符号表Xxx.sym，供反汇编器标注标签')
+    arg_parser.add_argument('-q','--quiet',action='store_true',help='不打印逐条翻译信息')
+    arg_parser.add_argument('-j','--jobs',type=int,default=0,
+                            help='单个文件时大于1表示先确定全部符号地址，再用多进程分段编码；批量汇编时为进程数')
+    arg_parser.add_argument('--cache-dir',help='启用增量汇编，未变化的源码直接使用该目录下缓存的结果')
+    arg_parser.add_argument('--cache-size',type=int,default=64,help='缓存目录大小上限(MB)，超出时淘汰最久未使用的条目')
+    arg_parser.add_argument('--stats',action='store_true',help='打印指令编码缓存命中率')
+    args=arg_parser.parse_args()
+    if args.stream and args.optimize:
+        arg_parser.error('流式汇编不支持优化')
+    if is_batch_input(args.file_paths):
+        file_paths=find_asm_files(args.file_paths)
+        if len(file_paths) == 0:
+            print('没有找到.asm文件')
+            exit(1)
+        succeeded=assemble_batch(file_paths,args.jobs if args.jobs > 0 else None,args.cache_dir,args.cache_size*1024*1024,
+                                 stream=args.stream,output_format=args.format,symbols=args.symbols,optimize=args.optimize)
+        exit(0 if succeeded else 1)
+    cache=None
+    if args.cache_dir is not None:
+        cache=AssemblyCache(args.cache_dir,args.cache_size*1024*1024)
+    assembler=assemble_file(args.file_paths[0],not args.quiet,args.stream,args.format,args.jobs,cache,args.symbols,
+                            args.optimize)
+    if args.optimize and not assembler.cache_hit:
+        print('优化结果:')
+        for optimizer in assembler.optimizers:
+            print(optimizer.report())
+    if args.stats and getattr(assembler,'cache_hit',False):
+        print('命中增量汇编缓存，跳过解析与编码')
+    elif args.stats:
+        translator=assembler.translator
+        print('指令编码缓存: 命中 %d, 未命中 %d, 命中率 %.2f%%' % (
+            translator.cache_hits,translator.cache_misses,translator.cache_hit_rate()*100))
@@ -0,0 +1,72 @@
+import os
+
+
+class ContentCache:
+    '''
+    以内容哈希为键的磁盘缓存，条目为字节串，由使用者自行序列化；
+    总大小超过上限时按最近访问时间淘汰最旧的条目
+    汇编器与VM翻译器共用
+    '''
+    def __init__(self,cache_dir:str,max_bytes:int=64*1024*1024) -> None:
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        os.makedirs(cache_dir,exist_ok=True)
+    def key(self,*parts)->str:
+        '''
+        parts 为 str 或 bytes，依次以 \\0 分隔后取 sha256
+        '''
+        # 只在启用缓存时导入
+        import hashlib
+        digest=hashlib.sha256()
+        for index,part in enumerate(parts):
+            if index > 0:
+                digest.update(b'\0')
+            digest.update(part if isinstance(part,bytes) else part.encode())
+        return digest.hexdigest()
+    def entry_path(self,key:str)->str:
+        return os.path.join(self.cache_dir,key+'.cache')
+    def get(self,key:str):
+        '''
+        命中时返回条目内容，否则返回None
+        '''
+        path=self.entry_path(key)
+        try:
+            with open(path,'rb') as f:
+                data=f.read()
+        except OSError:
+            return None
+        # 更新访问时间，供LRU淘汰使用；条目可能刚被其他进程淘汰，此时不影响已读到的内容
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+    def put(self,key:str,data:bytes):
+        path=self.entry_path(key)
+        # 先写临时文件再改名，避免并行进程读到写了一半的条目
+        temp_path=path+'.'+str(os.getpid())+'.tmp'
+        with open(temp_path,'wb') as f:
+            f.write(data)
+        os.replace(temp_path,path)
+        self.evict()
+    def evict(self):
+        entries=[]
+        total=0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.cache'):
+                continue
+            try:
+                stat=os.stat(os.path.join(self.cache_dir,filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,filename))
+            total+=stat.st_size
+        entries.sort()
+        for _,size,filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir,filename))
+            except OSError:
+                pass
+            total-=size
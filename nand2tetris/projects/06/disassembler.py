@@ -0,0 +1,158 @@
+from array import array
+import argparse
+import os
+
+from assember import CodeTranslator, SymbolTable, assemble, unpack_machine_codes
+
+try:
+    import numpy as np
+except ImportError:  # 没有numpy时逐条查表
+    np = None
+
+
+class Disassembler:
+    '''
+    Hack 机器码 -> 汇编代码
+    由 CodeTranslator 的 comp_map/dest_map/jump_map 反向生成查找表，按位段直接索引
+    '''
+    def __init__(self) -> None:
+        translator=CodeTranslator(SymbolTable(),False)
+        # a位与6位comp共7位，作为下标
+        self.comp_table=[None]*128
+        for comp,bits in translator.comp_map.items():
+            # 可交换运算的别名排在后面，保留标准写法
+            if self.comp_table[int(bits,2)] is None:
+                self.comp_table[int(bits,2)]=comp
+        self.dest_table=['']*8
+        for dest,bits in translator.dest_map.items():
+            if dest != 'NULL':
+                self.dest_table[int(bits,2)]=dest+'='
+        self.jump_table=['']*8
+        for jump,bits in translator.jump_map.items():
+            if jump != 'NULL':
+                self.jump_table[int(bits,2)]=';'+jump
+        # C指令低13位 -> 完整汇编文本，非法的comp为None
+        self.c_command_table=[None]*8192
+        for index in range(8192):
+            comp=self.comp_table[index>>6]
+            if comp is not None:
+                self.c_command_table[index]=self.dest_table[(index>>3)&7]+comp+self.jump_table[index&7]
+        # 地址 -> 标签名列表，地址 -> 变量名
+        self.labels={}
+        self.variables={}
+
+    def load_symbols(self,file_path:str):
+        '''
+        读取汇编器 --symbols 写出的符号表
+        '''
+        with open(file_path,'r') as f:
+            for line in f:
+                fields=line.split()
+                if len(fields) != 3:
+                    continue
+                kind,symbol,address=fields
+                if kind == 'label':
+                    self.labels.setdefault(int(address),[]).append(symbol)
+                elif kind == 'variable':
+                    self.variables[int(address)]=symbol
+
+    def decode(self,machine_codes)->list:
+        '''
+        一次性解码整个ROM，返回每条指令的汇编文本（不含标签与注释）
+        '''
+        if np is not None:
+            return self.decode_vectorized(machine_codes)
+        codes=[]
+        for machine_code in machine_codes:
+            if machine_code & 0x8000 == 0:
+                codes.append('@'+str(machine_code))
+                continue
+            code=self.c_command_table[machine_code&0x1FFF]
+            assert machine_code & 0xE000 == 0xE000 and code is not None,'非法指令'+format(machine_code,'016b')
+            codes.append(code)
+        return codes
+
+    def decode_vectorized(self,machine_codes)->list:
+        codes=np.asarray(machine_codes,dtype=np.uint16)
+        is_a_command=(codes & 0x8000) == 0
+        # 按低13位整体查表得到C指令文本，A指令位置随后覆盖
+        lines=np.array(self.c_command_table,dtype=object)[codes & 0x1FFF]
+        invalid=~is_a_command & (((codes & 0xE000) != 0xE000) | (lines == None))
+        assert not invalid.any(),'非法指令'+format(int(codes[invalid.argmax()]),'016b')
+        lines[is_a_command]=['@'+str(value) for value in codes[is_a_command].tolist()]
+        return lines.tolist()
+
+    def annotate(self,machine_codes,codes:list)->list:
+        '''
+        插入标签定义；跳转目标替换为标签名，访问变量的A指令附上变量名注释
+        标签名与地址一一对应，替换后重新汇编结果不变
+        '''
+        lines=[]
+        count=len(codes)
+        for address,code in enumerate(codes):
+            for label in self.labels.get(address,[]):
+                lines.append('('+label+')')
+            if code.startswith('@') and address+1 < count:
+                value=machine_codes[address]
+                next_code=machine_codes[address+1]
+                if next_code & 0x8000 and next_code & 7 and value in self.labels:
+                    code='@'+self.labels[value][0]
+                elif next_code & 0x8000 and next_code & 0x1008 and value in self.variables:
+                    # 下一条指令读或写M
+                    code=code+' // '+self.variables[value]
+            lines.append(code)
+        # 程序末尾的标签
+        for label in self.labels.get(count,[]):
+            lines.append('('+label+')')
+        return lines
+
+    def disassemble(self,machine_codes)->list:
+        return self.annotate(machine_codes,self.decode(machine_codes))
+
+
+def load_rom(file_path:str)->array:
+    '''
+    读取文本.hack或小端uint16紧凑格式.hackb
+    '''
+    if file_path.endswith('.hackb'):
+        with open(file_path,'rb') as f:
+            return unpack_machine_codes(f.read())
+    machine_codes=array('H')
+    with open(file_path,'r') as f:
+        for line in f:
+            line=line.strip()
+            if line != '':
+                machine_codes.append(int(line,2))
+    return machine_codes
+
+
+if __name__ == '__main__':
+    arg_parser=argparse.ArgumentParser(description='Hack disassembler')
+    arg_parser.add_argument('file_path',help='Xxx.hack 或 Xxx.hackb')
+    arg_parser.add_argument('-o','--output',help='输出文件，默认为 Xxx_dis.asm')
+    arg_parser.add_argument('--symbols',help='符号表文件，默认使用同目录下的 Xxx.sym（如果存在）')
+    arg_parser.add_argument('--check',action='store_true',help='将反汇编结果重新汇编，检查与原ROM一致')
+    args=arg_parser.parse_args()
+
+    base_path=args.file_path[:args.file_path.rfind('.')]
+    symbol_file_path=args.symbols
+    if symbol_file_path is None and os.path.isfile(base_path+'.sym'):
+        symbol_file_path=base_path+'.sym'
+    output_file_path=args.output if args.output is not None else base_path+'_dis.asm'
+
+    machine_codes=load_rom(args.file_path)
+    disassembler=Disassembler()
+    if symbol_file_path is not None:
+        disassembler.load_symbols(symbol_file_path)
+    lines=disassembler.disassemble(machine_codes)
+    with open(output_file_path,'w') as f:
+        for line in lines:
+            f.write(line)
+            f.write('\n')
+    print('反汇编 %d 条指令 -> %s' % (len(machine_codes),output_file_path))
+    if args.check:
+        reassembled,_=assemble(lines)
+        if reassembled != machine_codes:
+            print('重新汇编结果与原ROM不一致')
+            exit(1)
+        print('重新汇编结果与原ROM一致')
@@ -1,6 +1,8 @@
 import sys
 import os
 
+from vm_parser import Opcode, OPCODE_NAMES, parse_vm_file
+
 
 class CodeWriter:
     def __init__(self,filename:str) -> None:
@@ -71,12 +73,12 @@ class CodeWriter:
             # 使用D寄存器存放将要压栈的数据
             if segment == 'constant': # 立即数
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',  
                 ])
             elif segment in ['local','argument','this','that']: # 变址寻址——从寄存器指向内存中获取基址，加上索引获取数据所在内存地址，然后获取值
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',
                     '@'+self.segment_dict[segment],
                     'A=M+D',
@@ -84,7 +86,7 @@ class CodeWriter:
                 ])
             elif segment in ['temp','pointer']: # 变址寻址——从寄存器中获取基址，加上索引获取数据所在地址，然后获取值
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',
                     '@'+self.segment_dict[segment],
                     'A=A+D',
@@ -92,7 +94,7 @@ class CodeWriter:
                 ])
             else:  #segment == 'static' # 静态变量，文件名和静态变量数量作为静态变量名，获取其值
                 res.extend([
-                    '@'+self.base_filename[:-4]+'.'+index,
+                    '@'+self.base_filename[:-4]+'.'+str(index),
                     'D=M'
                 ])
             # 将数据压入栈，并增加栈指针SP
@@ -111,14 +113,14 @@ class CodeWriter:
             res=[]
             if segment in ['local','argument','this','that']: # 变址寻址——从寄存器指向内存中获取基址，加上索引获取数据所在内存地址，然后获取值
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',
                     '@'+self.segment_dict[segment],
                     'D=M+D',
                 ])
             elif segment in ['temp','pointer']: # 变址寻址——从寄存器中获取基址，加上索引获取数据所在地址，然后获取值
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',
                     '@'+self.segment_dict[segment],
                     'D=A+D',
@@ -126,7 +128,7 @@ class CodeWriter:
                 ])
             else:  #segment == 'static' # 静态变量，文件名和静态变量数量作为静态变量名，获取其值
                 res.extend([
-                    '@'+self.base_filename[:-4]+'.'+index,
+                    '@'+self.base_filename[:-4]+'.'+str(index),
                     'D=A',
                 ])
             res.extend([
@@ -162,7 +164,7 @@ if __name__ == '__main__':
     if os.path.isdir(input):
         for filename in os.listdir(input):
             if os.path.isfile(input+'/'+filename) and filename[-2:] == 'vm' :
-                    source_filenames.append(filename)
+                    source_filenames.append(input+'/'+filename)
         if len(source_filenames) == 0:
             print('请输入正确的vm文件名或目录')
             exit(1)
@@ -180,28 +182,17 @@ if __name__ == '__main__':
     for filename in source_filenames:
         assert filename[-2:] == 'vm','应输入名为Xxx.vm的文件'
         print("当前解析文件：",filename)
-        vm_commands=[]
-        with open(filename,'r') as f:
-            for command in f:
-                command=command.strip()
-                if len(command)==0 or command[0]=='/':
-                    continue
-                if command.find('/') !=-1:
-                    command=command[:command.find('/')]
-                command=command.strip()
-                vm_commands.append(command)
-        label_prefix = os.path.basename(filename)[:-3]
-        print('解析到的vm指令为',vm_commands)
-        for command in vm_commands:
-            print(command + '->')
+        program=parse_vm_file(filename)
+        print('解析到的vm指令为',program.text().split('\n'))
+        for index in range(len(program)):
+            print(program.command_text(index) + '->')
             # 写入结果
-            if command.startswith('push'):
-                fields=command.split(' ')
-                codeWriter.writePush(fields[1],fields[2])
-            elif command.startswith('pop'):
-                fields=command.split(' ')
-                codeWriter.writePop(fields[1],fields[2])
+            opcode=program.opcodes[index]
+            if opcode == Opcode.PUSH:
+                codeWriter.writePush(program.segment_name(index),program.operands[index])
+            elif opcode == Opcode.POP:
+                codeWriter.writePop(program.segment_name(index),program.operands[index])
             else:
-                codeWriter.writeArithmetic(command)
+                codeWriter.writeArithmetic(OPCODE_NAMES[opcode])
     codeWriter.save()
         
@@ -0,0 +1,192 @@
+from array import array
+from enum import IntEnum
+import os
+
+
+class Opcode(IntEnum):
+    PUSH=0
+    POP=1
+    ADD=2
+    SUB=3
+    NEG=4
+    EQ=5
+    GT=6
+    LT=7
+    AND=8
+    OR=9
+    NOT=10
+    LABEL=11
+    GOTO=12
+    IF_GOTO=13
+    FUNCTION=14
+    CALL=15
+    RETURN=16
+
+class Segment(IntEnum):
+    NONE=0
+    CONSTANT=1
+    LOCAL=2
+    ARGUMENT=3
+    THIS=4
+    THAT=5
+    TEMP=6
+    POINTER=7
+    STATIC=8
+
+# 指令名 <-> 操作码
+OPCODES={
+    'push':Opcode.PUSH,
+    'pop':Opcode.POP,
+    'add':Opcode.ADD,
+    'sub':Opcode.SUB,
+    'neg':Opcode.NEG,
+    'eq':Opcode.EQ,
+    'gt':Opcode.GT,
+    'lt':Opcode.LT,
+    'and':Opcode.AND,
+    'or':Opcode.OR,
+    'not':Opcode.NOT,
+    'label':Opcode.LABEL,
+    'goto':Opcode.GOTO,
+    'if-goto':Opcode.IF_GOTO,
+    'function':Opcode.FUNCTION,
+    'call':Opcode.CALL,
+    'return':Opcode.RETURN,
+}
+OPCODE_NAMES={opcode:name for name,opcode in OPCODES.items()}
+ARITHMETIC_OPCODES=frozenset([Opcode.ADD,Opcode.SUB,Opcode.NEG,Opcode.EQ,Opcode.GT,Opcode.LT,
+                              Opcode.AND,Opcode.OR,Opcode.NOT])
+COMPARE_OPCODES=frozenset([Opcode.EQ,Opcode.GT,Opcode.LT])
+
+# 段名 <-> 段编号
+SEGMENTS={
+    'constant':Segment.CONSTANT,
+    'local':Segment.LOCAL,
+    'argument':Segment.ARGUMENT,
+    'this':Segment.THIS,
+    'that':Segment.THAT,
+    'temp':Segment.TEMP,
+    'pointer':Segment.POINTER,
+    'static':Segment.STATIC,
+}
+SEGMENT_NAMES={segment:name for name,segment in SEGMENTS.items()}
+
+
+class VMProgram:
+    '''
+    一个vm文件的紧凑中间表示，每条指令占四个并列array中的同一下标
+    opcodes: Opcode；segments: Segment，非push/pop为NONE
+    operands: 段内下标、call的参数个数或function的局部变量个数
+    symbols: 标签名或函数名在names中的下标，没有时为-1
+    '''
+    def __init__(self,source_name:str='') -> None:
+        self.source_name=source_name
+        self.opcodes=array('B')
+        self.segments=array('B')
+        self.operands=array('i')
+        self.symbols=array('i')
+        self.names=[]
+        self.name_indexes={}
+    def __len__(self)->int:
+        return len(self.opcodes)
+    def intern(self,name:str)->int:
+        index=self.name_indexes.get(name)
+        if index is None:
+            index=len(self.names)
+            self.names.append(name)
+            self.name_indexes[name]=index
+        return index
+    def append(self,opcode:Opcode,segment:Segment=Segment.NONE,operand:int=0,name:str=None):
+        self.opcodes.append(opcode)
+        self.segments.append(segment)
+        self.operands.append(operand)
+        self.symbols.append(-1 if name is None else self.intern(name))
+    def name(self,index:int)->str:
+        return self.names[self.symbols[index]]
+    def segment_name(self,index:int)->str:
+        return SEGMENT_NAMES[self.segments[index]]
+    def command_text(self,index:int)->str:
+        '''
+        还原为规范的vm指令文本，用于注释与缓存键
+        '''
+        opcode=self.opcodes[index]
+        if opcode in (Opcode.PUSH,Opcode.POP):
+            return '%s %s %d' % (OPCODE_NAMES[opcode],SEGMENT_NAMES[self.segments[index]],self.operands[index])
+        if opcode in (Opcode.FUNCTION,Opcode.CALL):
+            return '%s %s %d' % (OPCODE_NAMES[opcode],self.name(index),self.operands[index])
+        if opcode in (Opcode.LABEL,Opcode.GOTO,Opcode.IF_GOTO):
+            return OPCODE_NAMES[opcode]+' '+self.name(index)
+        return OPCODE_NAMES[opcode]
+    def text(self)->str:
+        return '\n'.join(self.command_text(index) for index in range(len(self)))
+    def extract(self,indexes)->'VMProgram':
+        '''
+        按给定下标复制出一个新的程序
+        '''
+        program=VMProgram(self.source_name)
+        for index in indexes:
+            symbol=self.symbols[index]
+            program.append(self.opcodes[index],self.segments[index],self.operands[index],
+                           None if symbol < 0 else self.names[symbol])
+        return program
+
+
+def parse_push_pop(program:VMProgram,opcode:Opcode,fields:list):
+    segment=SEGMENTS.get(fields[1])
+    if segment is None or len(fields) != 3:
+        raise ValueError('非法VM码: '+' '.join(fields))
+    assert opcode == Opcode.PUSH or segment != Segment.CONSTANT,'不能pop到constant段'
+    program.append(opcode,segment,int(fields[2]))
+
+def parse_label(program:VMProgram,opcode:Opcode,fields:list):
+    if len(fields) != 2:
+        raise ValueError('非法VM码: '+' '.join(fields))
+    program.append(opcode,name=fields[1])
+
+def parse_function(program:VMProgram,opcode:Opcode,fields:list):
+    if len(fields) != 3:
+        raise ValueError('非法VM码: '+' '.join(fields))
+    program.append(opcode,operand=int(fields[2]),name=fields[1])
+
+def parse_no_argument(program:VMProgram,opcode:Opcode,fields:list):
+    if len(fields) != 1:
+        raise ValueError('非法VM码: '+' '.join(fields))
+    program.append(opcode)
+
+# 指令名 -> (操作码, 解析函数)
+PARSE_TABLE={name:(opcode,parse_no_argument) for name,opcode in OPCODES.items()}
+PARSE_TABLE.update({
+    'push':(Opcode.PUSH,parse_push_pop),
+    'pop':(Opcode.POP,parse_push_pop),
+    'label':(Opcode.LABEL,parse_label),
+    'goto':(Opcode.GOTO,parse_label),
+    'if-goto':(Opcode.IF_GOTO,parse_label),
+    'function':(Opcode.FUNCTION,parse_function),
+    'call':(Opcode.CALL,parse_function),
+})
+
+def parse_vm(lines,source_name:str='')->VMProgram:
+    '''
+    一遍扫描，按指令名查表解析；lines 为逐行产生vm代码的可迭代对象
+    '''
+    program=VMProgram(source_name)
+    for line in lines:
+        comment=line.find('//')
+        if comment != -1:
+            line=line[:comment]
+        fields=line.split()
+        if len(fields) == 0:
+            continue
+        entry=PARSE_TABLE.get(fields[0])
+        if entry is None:
+            raise ValueError('非法VM码: '+line.strip())
+        opcode,parse=entry
+        parse(program,opcode,fields)
+    return program
+
+def parse_vm_file(filename:str)->VMProgram:
+    '''
+    source_name 为不含 .vm 后缀的文件名
+    '''
+    with open(filename,'r') as f:
+        return parse_vm(f,os.path.basename(filename)[:-3])
@@ -1,9 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
 import sys
 import os
 
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','07'))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','06'))
+from content_cache import ContentCache
+from vm_parser import Opcode, COMPARE_OPCODES, OPCODE_NAMES, VMProgram, parse_vm_file
+from vm_optimizer import VMOptimizer
+
+
+# 代码生成或缓存格式变化时需要修改，使旧的缓存失效
+TRANSLATOR_VERSION='4'
+# 缓存片段中代替输出文件名的占位符，不会出现在合法的Hack符号中
+RELOCATION_MARK='%'
+# 单个vm文件翻译结果中需要合并的计数器，见 CodeWriter.record
+MERGED_COUNTERS=['call_count','return_count','fused_branch_count','fused_move_count',
+                 'cached_top_hits','static_sp_hits','sp_write_backs']
+TRANSLATION_RECORD_FIELDS=['commands','asm_codes','counters','compare_counts','local_init_stats']
+# 静态栈偏移模式下相对SP快照寻址的最大偏移，超出时写回SP
+MAX_STATIC_SP_OFFSET=2
+
+
+def instruction_count(codes:list)->int:
+    # 标签不占ROM
+    return sum(1 for code in codes if not code.startswith('('))
+
+def remove_dead_functions(programs:list,entry:str='Sys.init'):
+    '''
+    从entry出发，沿call指令构建调用图，删除不可达的函数
+    programs: [VMProgram]，返回过滤后的programs与被删除的函数名
+    '''
+    # 函数名 -> 调用的函数集合
+    call_graph={}
+    for program in programs:
+        current_function=None
+        for index in range(len(program)):
+            opcode=program.opcodes[index]
+            if opcode == Opcode.FUNCTION:
+                current_function=program.name(index)
+                call_graph[current_function]=set()
+            elif opcode == Opcode.CALL and current_function is not None:
+                call_graph[current_function].add(program.name(index))
+    if entry not in call_graph:
+        return programs,[]
+    reachable=set([entry])
+    stack=[entry]
+    while len(stack) > 0:
+        for callee in call_graph.get(stack.pop(),()):
+            if callee not in reachable:
+                reachable.add(callee)
+                stack.append(callee)
+    result=[]
+    removed=[]
+    for program in programs:
+        kept=[]
+        # 第一个function之前的指令保留
+        keep=True
+        for index in range(len(program)):
+            if program.opcodes[index] == Opcode.FUNCTION:
+                keep=program.name(index) in reachable
+                if not keep:
+                    removed.append(program.name(index))
+            if keep:
+                kept.append(index)
+        result.append(program if len(kept) == len(program) else program.extract(kept))
+    return result,removed
+
+def make_relocatable(asm_codes:list,base_filename:str)->list:
+    '''
+    以输出文件名开头的符号换成占位符，片段可以拼接到任意输出文件中
+    '''
+    prefix_length=len(base_filename)+1
+    result=[]
+    for codes in asm_codes:
+        result.append([code[0]+RELOCATION_MARK+code[prefix_length:]
+                       if code[0] in '@(' and code[1:prefix_length+1] == base_filename+'$' else code
+                       for code in codes])
+    return result
+
+def relocate(asm_codes:list,base_filename:str)->list:
+    return [[code[0]+base_filename+code[2:] if code[1:2] == RELOCATION_MARK else code for code in codes]
+            for codes in asm_codes]
+
+class TranslationCache(ContentCache):
+    '''
+    以vm指令、文件名与翻译选项的哈希为键，在磁盘上缓存单个vm文件的翻译结果，条目为JSON
+    '''
+    def key(self,program:VMProgram,options:str='')->str:
+        '''
+        静态变量与标签名中含有vm文件名，文件名不同的结果分开缓存
+        '''
+        return super().key(TRANSLATOR_VERSION,options,program.source_name,program.text())
+    def get(self,key:str,base_filename:str):
+        '''
+        命中时返回符号已重定位到base_filename的翻译结果（见 CodeWriter.record），否则返回None
+        '''
+        data=super().get(key)
+        if data is None:
+            return None
+        try:
+            record=json.loads(data)
+        except ValueError:
+            return None
+        if not isinstance(record,dict) or set(record) != set(TRANSLATION_RECORD_FIELDS):
+            return None
+        record['asm_codes']=relocate(record['asm_codes'],base_filename)
+        return record
+    def put(self,key:str,record:dict,base_filename:str):
+        record=dict(record,asm_codes=make_relocatable(record['asm_codes'],base_filename))
+        super().put(key,json.dumps(record).encode())
 
 class CodeWriter:
-    def __init__(self,filename:str,write_init_code:bool) -> None:
+    def __init__(self,filename:str,write_init_code:bool,compact_calls:bool=False,shared_compare:bool=False,
+                 cache_top:bool=False,optimize_for:str='speed',comments:str='full',static_sp:bool=False) -> None:
         self.arith_dict = {
             'not':'!',
             'neg':'-',
@@ -15,6 +126,18 @@ class CodeWriter:
             'lt':'JGE',
             'gt':'JLE',
         }
+        # 比较后直接跳转：条件成立时跳转的条件码
+        self.branch_dict = {
+            'eq':'JEQ',
+            'lt':'JLT',
+            'gt':'JGT',
+        }
+        # not 取反后的条件码
+        self.negated_branch_dict = {
+            'eq':'JNE',
+            'lt':'JGE',
+            'gt':'JLE',
+        }
         self.segment_dict = {
             'local':"LCL",
             'argument':'ARG',
@@ -30,11 +153,55 @@ class CodeWriter:
         self.ret_index=0
         self.write_init_code=write_init_code
         self.current_source_filename=''
+        # 体积优化：所有call/return共用一段全局例程，调用处只传参并跳转
+        self.compact_calls=compact_calls
+        self.call_count=0
+        self.return_count=0
+        # 体积优化：eq/lt/gt各用一段共享例程，R13存放返回地址
+        self.shared_compare=shared_compare
+        # vm文件名 -> {比较指令: 次数}
+        self.compare_counts={}
+        # 比较+if-goto 融合的次数
+        self.fused_branch_count=0
+        # 速度优化：栈顶缓存在D寄存器中，此时内存中的SP不包含栈顶
+        self.cache_top=cache_top
+        self.top_in_d=False
+        # 直接使用D中栈顶、省去一次存取的次数
+        self.cached_top_hits=0
+        # 速度优化：基本块内按翻译时已知的偏移相对SP快照寻址，只在块出口、调用、返回处写回SP
+        # 此时实际的栈指针为 M[SP]+sp_offset
+        self.static_sp=static_sp
+        self.sp_offset=0
+        # 不修改SP的栈访问次数与写回SP的次数
+        self.static_sp_hits=0
+        self.sp_write_backs=0
+        # push/pop 融合为直接传送的次数
+        self.fused_move_count=0
+        # 局部变量清零的取舍：'speed' 总是展开，'size' 在循环更短时使用循环
+        assert optimize_for in ['speed','size']
+        self.optimize_for=optimize_for
+        # 策略 -> [函数个数, 指令数]
+        self.local_init_stats={}
+        # 输出注释：'full'、'compact' 或 'none'
+        assert comments in ['full','compact','none']
+        self.comments=comments
+        self.commands=[]
+        self.rom_size=0
+        self.output_index=0
         pass
     def set_current_vm_source(self,source_filename:str):
         self.current_source_filename=source_filename
+        # 计数器按文件独立，各文件可以单独翻译后再合并
+        self.symbol_index=0
+        self.ret_index=0
+    def file_symbol(self,name:str)->str:
+        symbol=name+'$'+self.current_source_filename+'$'+str(self.symbol_index)
+        self.symbol_index+=1
+        return symbol
     def function_symbol(self,function_name:str):
         return self.base_filename+'$func$'+function_name
+    def routine_symbol(self,name:str):
+        return self.base_filename+'$routine$'+name
     def function_return_address_symbol(self,function_name:str):
         return self.base_filename+'$func$'+function_name+'_return_address'
     def label_symbol(self,label:str):
@@ -42,123 +209,348 @@ class CodeWriter:
     def static_variable_name(self,index):
         # 每个vm文件下的静态变量应当是不与其他vm文件下的发生冲突，故引入当前文件名
         assert self.current_source_filename !=''
-        return self.base_filename+'$'+self.current_source_filename+'$static$'+index
+        return self.base_filename+'$'+self.current_source_filename+'$static$'+str(index)
+    def FlushCode(self)->list:
+        '''
+        栈顶在D中时写回内存，在标签、跳转、调用、返回前使用
+        '''
+        if not self.top_in_d:
+            return []
+        self.top_in_d=False
+        return self.PushDCode()
+    def BlockExitCode(self)->list:
+        '''
+        基本块出口（标签、跳转、调用、返回、函数入口）前，写回D中的栈顶与SP
+        '''
+        res=self.FlushCode()
+        res.extend(self.WriteBackSPCode())
+        return res
+    def StackAddressCode(self,offset:int)->list:
+        '''
+        A = M[SP]+offset，不使用D，用 A=M±1 链，长度随偏移增长
+        '''
+        if offset == 0:
+            return ['@SP','A=M']
+        if offset > 0:
+            return ['@SP','A=M+1']+['A=A+1']*(offset-1)
+        return ['@SP','A=M-1']+['A=A-1']*(-offset-1)
+    def PushDCode(self)->list:
+        '''
+        D 入栈
+        '''
+        if not self.static_sp:
+            return [
+                '@SP',
+                'A=M',
+                'M=D',
+                '@SP',
+                'M=M+1',
+            ]
+        self.static_sp_hits+=1
+        res=self.RebaseSPCode(self.sp_offset)
+        res.extend(self.StackAddressCode(self.sp_offset))
+        res.append('M=D')
+        self.sp_offset+=1
+        return res
+    def PopAddressCode(self)->list:
+        '''
+        出栈，A = 出栈元素的地址
+        '''
+        if not self.static_sp:
+            return [
+                '@SP',
+                'AM=M-1',
+            ]
+        self.static_sp_hits+=1
+        res=self.RebaseSPCode(self.sp_offset-1)
+        self.sp_offset-=1
+        res.extend(self.StackAddressCode(self.sp_offset))
+        return res
+    def TopAddressCode(self)->list:
+        '''
+        A = 栈顶元素的地址，不出栈
+        '''
+        if not self.static_sp:
+            return [
+                '@SP',
+                'A=M-1',
+            ]
+        res=self.RebaseSPCode(self.sp_offset-1)
+        res.extend(self.StackAddressCode(self.sp_offset-1))
+        return res
+    def RebaseSPCode(self,offset:int)->list:
+        '''
+        要访问的偏移过大、A=M±1 链比直接修改SP更长时，先写回SP重新取快照，不使用D
+        '''
+        if abs(offset) <= MAX_STATIC_SP_OFFSET:
+            return []
+        return self.WriteBackSPCode(keep_d=True)
+    def WriteBackSPCode(self,keep_d:bool=False)->list:
+        '''
+        SP = M[SP]+sp_offset，偏移清零；keep_d 时不使用D
+        '''
+        offset=self.sp_offset
+        if offset == 0:
+            return []
+        self.sp_offset=0
+        self.sp_write_backs+=1
+        if abs(offset) > 3 and not keep_d:
+            return [
+                '@'+str(abs(offset)),
+                'D=A',
+                '@SP',
+                'M=M+D' if offset > 0 else 'M=M-D',
+            ]
+        return ['@SP']+['M=M+1' if offset > 0 else 'M=M-1']*abs(offset)
+    def CachedArithmeticCode(self,command:str)->list:
+        '''
+        栈顶在D中时的算术运算，结果留在D中
+        '''
+        self.cached_top_hits+=1
+        if command in ['not','neg']:
+            return ['D='+self.arith_dict[command]+'D']
+        # A指向第一个操作数，同时出栈
+        res=self.PopAddressCode()
+        if command in ['add','sub','and','or']:
+            res.append('D=M'+self.arith_dict[command]+'D')
+            return res
+        symbol = self.file_symbol(self.base_filename+'$'+command)
+        res.extend([
+            'D=M-D',
+            '@'+symbol+'_true',
+            'D;'+self.branch_dict[command],
+            'D=0',
+            '@'+symbol+'_end',
+            '0;JMP',
+            '('+symbol+'_true)',
+            'D=-1',
+            '('+symbol+'_end)',
+        ])
+        return res
     def writeArithmetic(self,command:str):
         assert command in ['not','neg','add','sub','and','or','eq','lt','gt'],'不支持的指令'
         res = []
-        if command in ['not','neg']: # 单参数
-            res.extend([
-                '@SP',
-                'A=M-1',
-                'M='+self.arith_dict[command]+'M'
-            ])
+        if command in ['eq','gt','lt']:
+            counts=self.compare_counts.setdefault(self.current_source_filename,{})
+            counts[command]=counts.get(command,0)+1
+        if self.top_in_d and not (self.shared_compare and command in ['eq','gt','lt']):
+            res.extend(self.CachedArithmeticCode(command))
+        elif command in ['not','neg']: # 单参数
+            res.extend(self.TopAddressCode())
+            res.append('M='+self.arith_dict[command]+'M')
         elif command in ['add','sub','and','or']: # 双参数
+            res.extend(self.PopAddressCode()) # 同时完成SP=SP-1
             res.extend([
-                '@SP',
-                'AM=M-1', # 同时完成SP=SP-1并存入SP
                 'D=M', # 取得第二个参数 D = M[SP-1]
                 'A=A-1', 
                 'M=M'+self.arith_dict[command]+'D' # M[SP-2]=M[SP-2] op D
             ])
         else: # command in ['eq','gt','lt']
-            # 创建一个符号
-            symbol = self.base_filename[:-4]+'_'+command+'_'+str(self.symbol_index)
-            self.symbol_index+=1
-            res.extend([
-                '@SP',
-                'AM=M-1', # 同时完成SP=SP-1
-                'D=M',# 获取第二个操作数
-                'A=A-1',
-                'D=M-D', # D = M[SP-2] - M[SP-1]
-                'M=0', # M[SP-2] = False
-                '@'+symbol,
-                'D;'+self.arith_dict[command],
-                '@SP',
-                'A=M-1',
-                'M=-1', # M[SP-2] = True
-                '('+symbol+')',
-            ])
-        print(res)
-        self.asm_codes.append(res)
+            if self.shared_compare:
+                # D = 返回地址，跳到共享例程，例程使用内存中的SP
+                res.extend(self.BlockExitCode())
+                return_address=self.file_symbol(self.routine_symbol(command)+'$ret')
+                res.extend([
+                    '@'+return_address,
+                    'D=A',
+                    '@'+self.routine_symbol(command),
+                    '0;JMP',
+                    '('+return_address+')',
+                ])
+            else:
+                # 创建一个符号
+                symbol = self.file_symbol(self.base_filename+'$'+command)
+                if self.static_sp:
+                    res.extend(self.StaticCompareCode(command,symbol))
+                else:
+                    res.extend(self.CompareCode(command,symbol))
+        self.emit(res)
+    def CompareCode(self,command:str,symbol:str)->list:
+        return [
+            '@SP',
+            'AM=M-1', # 同时完成SP=SP-1
+            'D=M',# 获取第二个操作数
+            'A=A-1',
+            'D=M-D', # D = M[SP-2] - M[SP-1]
+            'M=0', # M[SP-2] = False
+            '@'+symbol,
+            'D;'+self.arith_dict[command],
+            '@SP',
+            'A=M-1',
+            'M=-1', # M[SP-2] = True
+            '('+symbol+')',
+        ]
+    def StaticCompareCode(self,command:str,symbol:str)->list:
+        '''
+        与CompareCode相同，栈元素相对SP快照寻址，不修改SP
+        跳转之后只有一条路径会执行，需要写回SP时必须在跳转之前完成
+        '''
+        res=self.RebaseSPCode(self.sp_offset-2)
+        res.extend(self.PopAddressCode())
+        res.extend([
+            'D=M',
+            'A=A-1',
+            'D=M-D',
+            'M=0',
+            '@'+symbol,
+            'D;'+self.arith_dict[command],
+        ])
+        res.extend(self.TopAddressCode())
+        res.extend([
+            'M=-1',
+            '('+symbol+')',
+        ])
+        return res
+    def CompareRoutine(self,command:str)->list:
+        '''
+        eq/lt/gt共享例程：进入时D=返回地址
+        '''
+        res=[
+            '('+self.routine_symbol(command)+')',
+            '@R13',
+            'M=D',
+        ]
+        res.extend(self.CompareCode(command,self.routine_symbol(command)+'$end'))
+        res.extend([
+            '@R13',
+            'A=M',
+            '0;JMP',
+        ])
+        return res
     def writePush(self,segment:str,index:int):
             assert segment in ['constant','local','argument','this','that','temp','pointer','static'],'不支持的段名'
-            res=[]
             # 使用D寄存器存放将要压栈的数据
+            res=self.LoadCode(segment,index)
+            if self.cache_top:
+                # 先写回原来的栈顶，新的栈顶留在D中
+                res[0:0]=self.FlushCode()
+                self.top_in_d=True
+                self.emit(res)
+                return
+            # 将数据压入栈，并增加栈指针SP
+            res.extend(self.PushDCode())
+            self.emit(res)
+    def LoadCode(self,segment:str,index:int)->list:
+            '''
+            D = segment[index]
+            '''
+            res=[]
             if segment == 'constant': # 立即数
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',  
                 ])
+            elif segment in ['local','argument','this','that'] and len(self.AddressCode(segment,index)) < 4:
+                # 小下标用 A=M+1 链，比通用的5条指令短
+                res.extend(self.AddressCode(segment,index))
+                res.append('D=M')
             elif segment in ['local','argument','this','that']: # 变址寻址——从寄存器指向内存中获取基址，加上索引获取数据所在内存地址，然后获取值
                 res.extend([
-                    '@'+index,
+                    '@'+str(index),
                     'D=A',
                     '@'+self.segment_dict[segment],
                     'A=M+D',
                     'D=M'
                 ])
-            elif segment in ['temp','pointer']: # 变址寻址——从寄存器中获取基址，加上索引获取数据所在地址，然后获取值
-                res.extend([
-                    '@'+index,
-                    'D=A',
-                    '@'+self.segment_dict[segment],
-                    'A=A+D',
-                    'D=M'
-                ])
-            else:  #segment == 'static' # 静态变量，文件名和静态变量数量作为静态变量名，获取其值
-                res.extend([
-                    '@'+self.static_variable_name(index),
-                    'D=M'
-                ])
-            # 将数据压入栈，并增加栈指针SP
-            res.extend([
-                    '@SP',
-                    'A=M',
-                    'M=D',
-                    '@SP',
-                    'M=M+1'
-            ])
-            print(res)
-            self.asm_codes.append(res)
+            else: # temp/pointer/static 地址在翻译时即可确定
+                res.extend(self.AddressCode(segment,index))
+                res.append('D=M')
+            return res
 
     def writePop(self,segment:str,index:int):
             assert segment in ['local','argument','this','that','temp','pointer','static'],'不支持的段名'
-            res=[]
-            if segment in ['local','argument','this','that']: # 变址寻址——从寄存器指向内存中获取基址，加上索引获取数据所在内存地址，然后获取值
-                res.extend([
-                    '@'+index,
-                    'D=A',
-                    '@'+self.segment_dict[segment],
-                    'D=M+D',
-                ])
-            elif segment in ['temp','pointer']: # 变址寻址——从寄存器中获取基址，加上索引获取数据所在地址，然后获取值
-                res.extend([
-                    '@'+index,
-                    'D=A',
-                    '@'+self.segment_dict[segment],
-                    'D=A+D',
-                    
-                ])
-            else:  #segment == 'static' # 静态变量，文件名和静态变量数量作为静态变量名，获取其值
-                res.extend([
-                    '@'+self.static_variable_name(index),
-                    'D=A',
-                ])
+            if self.top_in_d:
+                self.writeCachedPop(segment,index)
+                return
+            address=self.AddressCode(segment,index)
+            if len(address) < 8:
+                # 直接寻址，不经过R15（通用写法12条指令）
+                res=self.PopAddressCode()
+                res.append('D=M')
+                res.extend(address)
+                res.append('M=D')
+                self.emit(res)
+                return
+            # 变址寻址——从寄存器指向内存中获取基址，加上索引获取数据所在内存地址
+            res=[
+                '@'+str(index),
+                'D=A',
+                '@'+self.segment_dict[segment],
+                'D=M+D',
+            ]
             res.extend([
                 # 使用R15存放目标地址
                 '@R15',
                 'M=D',
-                # 获取栈数据
-                '@SP',
-                'AM=M-1',# A=M[SP]-1
+            ])
+            # 获取栈数据
+            res.extend(self.PopAddressCode())
+            res.extend([
                 'D=M', # D=M[M[SP]-1]]
                 # 存放值
                 '@R15',
                 'A=M',
                 'M=D'
             ])
-            print(res)
-            self.asm_codes.append(res)
+            self.emit(res)
+    def writeCachedPop(self,segment:str,index:int):
+        '''
+        栈顶在D中时出栈，内存中的SP已不包含栈顶，无需再修改SP
+        '''
+        self.top_in_d=False
+        self.cached_top_hits+=1
+        res=self.StoreCode(segment,index)
+        self.emit(res)
+    def writeMove(self,source_segment:str,source_index:int,segment:str,index:int):
+        '''
+        push x; pop y 融合为内存间直接传送，不经过栈
+        '''
+        assert source_segment in ['constant','local','argument','this','that','temp','pointer','static'],'不支持的段名'
+        assert segment in ['local','argument','this','that','temp','pointer','static'],'不支持的段名'
+        self.fused_move_count+=1
+        # D会被覆盖，先写回缓存的栈顶
+        res=self.FlushCode()
+        res.extend(self.LoadCode(source_segment,source_index))
+        res.extend(self.StoreCode(segment,index))
+        self.emit(res)
+    def AddressCode(self,segment:str,index:int)->list:
+        '''
+        A = segment[index] 的地址，不使用D
+        static/temp/pointer 直接寻址，其余用 A=M+1 链，长度随下标增长
+        '''
+        if segment == 'static':
+            return ['@'+self.static_variable_name(index)]
+        if segment == 'temp':
+            return ['@R'+str(5+int(index))]
+        if segment == 'pointer':
+            return ['@'+['THIS','THAT'][int(index)]]
+        if int(index) == 0:
+            return ['@'+self.segment_dict[segment],'A=M']
+        return ['@'+self.segment_dict[segment],'A=M+1']+['A=A+1']*(int(index)-1)
+    def StoreCode(self,segment:str,index:int)->list:
+        '''
+        segment[index] = D
+        '''
+        address=self.AddressCode(segment,index)
+        if len(address) < 12:
+            # 直接寻址（通用写法13条指令）
+            return address+['M=D']
+        return [
+            # R13暂存值，R14存放目标地址
+            '@R13',
+            'M=D',
+            '@'+str(index),
+            'D=A',
+            '@'+self.segment_dict[segment],
+            'D=M+D',
+            '@R14',
+            'M=D',
+            '@R13',
+            'D=M',
+            '@R14',
+            'A=M',
+            'M=D',
+        ]
     def InitCode(self)->list:
         res=[]
         # 初始化寄存器 SP
@@ -233,39 +625,93 @@ class CodeWriter:
             
     def writeLabel(self,label:str):
         # TODO 检查label有效性
-        res=[]
+        res=self.BlockExitCode()
         res.extend([
             '('+self.label_symbol(label)+')',
         ])
-        print(res)
-        self.asm_codes.append(res)
+        self.emit(res)
     def writeGoto(self,label:str):
-        res=[]
+        res=self.BlockExitCode()
         res.extend([
             '@'+self.label_symbol(label),
             '0;JMP'
         ])
-        print(res)
-        self.asm_codes.append(res)
+        self.emit(res)
     def writeIf(self,label:str):
         res=[]
-        res.extend([
+        if self.top_in_d:
+            # 条件值已在D中
+            self.top_in_d=False
+            self.cached_top_hits+=1
+        else:
             # 获取栈顶数据
-            '@SP',
-            'AM=M-1',
-            'D=M',
+            res.extend(self.PopAddressCode())
+            res.append('D=M')
+        # 跳转前写回SP，保留D中的条件值
+        res.extend(self.WriteBackSPCode(keep_d=True))
+        res.extend([
             # -1 表示 True
             # 0 表示 False
             # 设置跳转地址
             '@'+self.label_symbol(label),
             'D;JNE'
         ])
-        print(res)
-        self.asm_codes.append(res)
-    def writeCall(self,function_name:str,numArgs:int):
+        self.emit(res)
+    def writeCompareIf(self,command:str,negate:bool,label:str):
+        '''
+        eq/lt/gt [not] if-goto 融合为一次条件跳转，不再在栈上生成布尔值
+        '''
+        jump=self.negated_branch_dict[command] if negate else self.branch_dict[command]
+        self.fused_branch_count+=1
         res=[]
-        current_return_address = self.function_return_address_symbol(function_name)+str(self.ret_index)
+        if self.top_in_d:
+            # 第二个操作数已在D中
+            self.top_in_d=False
+            self.cached_top_hits+=1
+        else:
+            res.extend(self.PopAddressCode())
+            res.append('D=M') # 第二个操作数
+        res.extend(self.PopAddressCode())
+        res.append('D=M-D') # D = x - y，两个操作数均已出栈
+        res.extend(self.WriteBackSPCode(keep_d=True))
+        res.extend([
+            '@'+self.label_symbol(label),
+            'D;'+jump,
+        ])
+        self.emit(res)
+    def writeCall(self,function_name:str,numArgs:int):
+        current_return_address = self.function_return_address_symbol(function_name)+'$'+self.current_source_filename+'$'+str(self.ret_index)
         self.ret_index+=1
+        self.call_count+=1
+        if self.compact_calls:
+            res=self.CompactCallCode(function_name,numArgs,current_return_address)
+        else:
+            res=self.CallCode(function_name,numArgs,current_return_address)
+        res[0:0]=self.BlockExitCode()
+        self.emit(res)
+    def CompactCallCode(self,function_name:str,numArgs:int,current_return_address:str)->list:
+        res=[]
+        res.extend([
+            # R13 = f
+            '@'+self.function_symbol(function_name),
+            'D=A',
+            '@R13',
+            'M=D',
+            # R14 = n + 5
+            '@'+str(numArgs+5),
+            'D=A',
+            '@R14',
+            'M=D',
+            # D = 返回地址，跳到全局call例程
+            '@'+current_return_address,
+            'D=A',
+            '@'+self.routine_symbol('call'),
+            '0;JMP',
+            '('+current_return_address+')',
+        ])
+        return res
+    def CallCode(self,function_name:str,numArgs:int,current_return_address:str)->list:
+        res=[]
         res.extend([
             # 获取返回值地址，并压入栈中
             '@'+current_return_address,
@@ -312,9 +758,19 @@ class CodeWriter:
             # (return_address)
             '('+current_return_address+')',
         ])
-        print(res)
-        self.asm_codes.append(res)
+        return res
     def writeReturn(self):
+        self.return_count+=1
+        if self.compact_calls:
+            res=[
+                '@'+self.routine_symbol('return'),
+                '0;JMP',
+            ]
+        else:
+            res=self.ReturnCode()
+        res[0:0]=self.BlockExitCode()
+        self.emit(res)
+    def ReturnCode(self)->list:
         res=[]
         res.extend([
             # R15 = LCL
@@ -361,62 +817,418 @@ class CodeWriter:
             'A=M',
             '0;JMP',
         ])
-        print(res)
-        self.asm_codes.append(res)
-    def writeFunction(self,function_name:str,numLocals:int):
+        return res
+    def CallRoutine(self)->list:
+        '''
+        全局call例程：D=返回地址，R13=被调函数地址，R14=参数个数+5
+        '''
+        res=[
+            '('+self.routine_symbol('call')+')',
+            # 压入返回地址
+            '@SP',
+            'A=M',
+            'M=D',
+            '@SP',
+            'M=M+1',
+        ]
+        for segment_name in ['LCL','ARG','THIS','THAT']:
+            res.extend([
+                '@'+segment_name,
+                'D=M',
+                '@SP',
+                'A=M',
+                'M=D',
+                '@SP',
+                'M=M+1',
+            ])
+        res.extend([
+            # ARG = SP - n - 5
+            '@R14',
+            'D=M',
+            '@SP',
+            'D=M-D',
+            '@ARG',
+            'M=D',
+            # LCL=SP
+            '@SP',
+            'D=M',
+            '@LCL',
+            'M=D',
+            # goto f
+            '@R13',
+            'A=M',
+            '0;JMP',
+        ])
+        return res
+    def ReturnRoutine(self)->list:
+        '''
+        全局return例程，与内联的return相同
+        '''
+        return ['('+self.routine_symbol('return')+')']+self.ReturnCode()
+    def used_compare_commands(self)->list:
+        if not self.shared_compare:
+            return []
+        return [command for command in ['eq','lt','gt']
+                if any(command in counts for counts in self.compare_counts.values())]
+    def SharedRoutines(self)->list:
+        '''
+        体积优化模式下用到的全局例程，放在程序末尾，前面加一个死循环防止顺序执行进入
+        '''
         res=[]
+        if self.compact_calls and self.call_count > 0:
+            res.extend(self.CallRoutine())
+        if self.compact_calls and self.return_count > 0:
+            res.extend(self.ReturnRoutine())
+        for command in self.used_compare_commands():
+            res.extend(self.CompareRoutine(command))
+        if len(res) == 0:
+            return []
+        return [
+            '('+self.routine_symbol('halt')+')',
+            '@'+self.routine_symbol('halt'),
+            '0;JMP',
+        ]+res
+    def report(self)->list:
+        '''
+        翻译统计：ROM指令数与call/return的体积、周期开销
+        '''
+        rom_size=self.rom_size
+        shared_routines=self.SharedRoutines()
+        rom_size+=instruction_count(shared_routines)
+        if self.write_init_code:
+            rom_size+=instruction_count(self.InitCode())
+        lines=['ROM指令数: %d' % rom_size]
+        inline_call=instruction_count(self.CallCode('f',0,'ret'))
+        inline_return=instruction_count(self.ReturnCode())
+        if self.compact_calls:
+            # 调用处只传参并跳转，执行时比内联多出传参与跳转的开销
+            call_site=instruction_count(self.CompactCallCode('f',0,'ret'))
+            call_cycles=call_site+instruction_count(self.CallRoutine())
+            lines.append('call: %d 处, 每处 %d 条指令(内联 %d), 每次执行 %d 条(内联 %d)' % (
+                self.call_count,call_site,inline_call,call_cycles,inline_call))
+            lines.append('return: %d 处, 每处 2 条指令(内联 %d), 每次执行 %d 条(内联 %d)' % (
+                self.return_count,inline_return,2+inline_return,inline_return))
+            lines.append('全局例程: %d 条指令' % instruction_count(shared_routines))
+        else:
+            lines.append('call: %d 处, 每处 %d 条指令' % (self.call_count,inline_call))
+            lines.append('return: %d 处, 每处 %d 条指令' % (self.return_count,inline_return))
+        for policy in ['unrolled','loop']:
+            if policy in self.local_init_stats:
+                lines.append('局部变量清零(%s): %s %d 个函数, %d 条指令' % (
+                    self.optimize_for,{'unrolled':'展开','loop':'循环'}[policy],
+                    self.local_init_stats[policy][0],self.local_init_stats[policy][1]))
+        if self.cache_top:
+            lines.append('D寄存器缓存栈顶: 省去 %d 次入栈/出栈' % self.cached_top_hits)
+        if self.static_sp:
+            lines.append('静态栈偏移: %d 次入栈/出栈不修改SP, 写回SP %d 次' % (self.static_sp_hits,self.sp_write_backs))
+        if self.fused_move_count > 0:
+            lines.append('push/pop 融合为直接传送: %d 处' % self.fused_move_count)
+        if self.fused_branch_count > 0:
+            lines.append('比较+if-goto 融合: %d 处' % self.fused_branch_count)
+        if self.shared_compare:
+            # 每处比较节省的指令数，未扣除共享例程本身
+            saved=instruction_count(self.CompareCode('eq','end'))-4
+            for source_filename,counts in self.compare_counts.items():
+                lines.append('%s: eq %d, lt %d, gt %d, 节省 %d 条指令' % (
+                    source_filename,counts.get('eq',0),counts.get('lt',0),counts.get('gt',0),
+                    saved*sum(counts.values())))
+            lines.append('比较例程: %d 条指令' % sum(
+                instruction_count(self.CompareRoutine(command)) for command in self.used_compare_commands()))
+        return lines
+    def writeFunction(self,function_name:str,numLocals:int):
+        res=self.BlockExitCode()
         res.extend([    
             # (f)
             '('+self.function_symbol(function_name) + ')',
         ])
-        for i in range(0,numLocals):
-            res.extend([    
+        policy=self.local_init_policy(numLocals)
+        if policy == 'loop':
+            init_code=self.LocalInitLoopCode(function_name,numLocals)
+        else:
+            init_code=self.LocalInitUnrolledCode(numLocals)
+        stats=self.local_init_stats.setdefault(policy,[0,0])
+        stats[0]+=1
+        stats[1]+=instruction_count(init_code)
+        res.extend(init_code)
+        self.emit(res)
+
+    def local_init_policy(self,numLocals:int)->str:
+        if numLocals == 0:
+            return 'none'
+        if self.optimize_for == 'size' and \
+                instruction_count(self.LocalInitLoopCode('f',numLocals)) < instruction_count(self.LocalInitUnrolledCode(numLocals)):
+            return 'loop'
+        return 'unrolled'
+    def LocalInitUnrolledCode(self,numLocals:int)->list:
+        '''
+        逐个清零后一次性设置SP，2n+4条指令
+        '''
+        if numLocals == 0:
+            return []
+        if numLocals == 1:
+            return [
                 '@SP',
-                'A=M',
+                'AM=M+1',
+                'A=A-1',
+                'M=0',
+            ]
+        res=[
+            '@SP',
+            'A=M',
+            'M=0',
+        ]
+        for i in range(1,numLocals):
+            res.extend([
+                'A=A+1',
                 'M=0',
-                '@SP',
-                'M=M+1',
             ])
-        print(res)
-        self.asm_codes.append(res)
+        res.extend([
+            'D=A+1',
+            '@SP',
+            'M=D',
+        ])
+        return res
+    def LocalInitLoopCode(self,function_name:str,numLocals:int)->list:
+        '''
+        循环压入numLocals个0，固定9条指令，每个局部变量执行7条
+        '''
+        symbol=self.function_symbol(function_name)+'$init'
+        return [
+            '@'+str(numLocals),
+            'D=A',
+            '('+symbol+')',
+            '@SP',
+            'AM=M+1',
+            'A=A-1',
+            'M=0',
+            'D=D-1',
+            '@'+symbol,
+            'D;JGT',
+        ]
 
-    
-    def save(self,commands):
-        current = 0
+    def begin_command(self,command:str):
+        '''
+        记录接下来要翻译的VM指令文本，用于输出注释
+        '''
+        self.commands.append(command)
+    def emit(self,codes:list):
+        print(codes)
+        self.rom_size+=instruction_count(codes)
+        self.asm_codes.append(codes)
+    def emit_tail(self,codes:list):
+        '''
+        追加到上一条VM指令的汇编代码之后
+        '''
+        if len(codes) == 0:
+            return
+        self.rom_size+=instruction_count(codes)
+        self.asm_codes[-1].extend(codes)
+    def record(self)->dict:
+        '''
+        单独翻译一个vm文件的结果，只含列表、字典、字符串与整数，可跨进程传递或写入缓存
+        '''
+        return {
+            'commands':self.commands,
+            'asm_codes':self.asm_codes,
+            'counters':{name:getattr(self,name) for name in MERGED_COUNTERS},
+            'compare_counts':self.compare_counts,
+            'local_init_stats':self.local_init_stats,
+        }
+    def absorb(self,record:dict):
+        '''
+        合并单独翻译一个vm文件的结果（见 record），按文件顺序调用
+        '''
+        for command,codes in zip(record['commands'],record['asm_codes']):
+            self.begin_command(command)
+            self.emit(codes)
+        for name,value in record['counters'].items():
+            setattr(self,name,getattr(self,name)+value)
+        self.compare_counts.update(record['compare_counts'])
+        for policy,(functions,size) in record['local_init_stats'].items():
+            stats=self.local_init_stats.setdefault(policy,[0,0])
+            stats[0]+=functions
+            stats[1]+=size
+    def write_codes(self,f,codes:list,command:str=None):
+        '''
+        full: //-start/-end 注释与指令序号；compact: 每条VM指令一行注释；none: 不写注释
+        '''
+        if command is not None and self.comments == 'full':
+            f.write('//-start '+ command+'\n')
+        elif command is not None and self.comments == 'compact':
+            f.write('// '+ command+'\n')
+        for code in codes:
+            if code.startswith('('):
+                f.write(code)
+            elif self.comments == 'full':
+                f.write(code+'      //'+str(self.output_index))
+                self.output_index+=1
+            else:
+                f.write(code)
+            f.write('\n')
+        if command is not None and self.comments == 'full':
+            f.write('//-end '+ command+'\n')
+    def save(self):
+        # 最后一条指令之后栈顶可能仍在D中，SP可能尚未写回
+        self.emit_tail(self.BlockExitCode())
         with open(self.output_filename,'w') as f:
-            idx=0
             if self.write_init_code:
-                for code in self.InitCode():
-                    if code.startswith('('):
-                        f.write(code)
-                    else:
-                        f.write(code+'      //'+str(idx))
-                        idx+=1
-                    f.write('\n')
-            for codes in self.asm_codes:
-                f.write('//-start '+ commands[current]+'\n')
-                for code in codes:
-                    if code.startswith('('):
-                        f.write(code)
-                    else:
-                        f.write(code+'      //'+str(idx))
-                        idx+=1
-                    f.write('\n')
-                f.write('//-end '+ commands[current]+'\n')
-                current+=1
+                self.write_codes(f,self.InitCode())
+            for command,codes in zip(self.commands,self.asm_codes):
+                self.write_codes(f,codes,command)
+            self.write_codes(f,self.SharedRoutines())
         return
 
+
+class StreamingCodeWriter(CodeWriter):
+    '''
+    每条VM指令翻译后写入输出文件，不保留asm_codes，内存占用不随程序大小增长
+    只暂存最近一条VM指令的汇编代码，emit_tail 追加在它之后，输出与 CodeWriter 完全一致
+    '''
+    def __init__(self,filename:str,write_init_code:bool,**options) -> None:
+        super().__init__(filename,write_init_code,**options)
+        self.output=open(self.output_filename,'w')
+        self.current_command=None
+        # 尚未写出的 (VM指令, 汇编代码)
+        self.pending=None
+        if write_init_code:
+            self.write_codes(self.output,self.InitCode())
+    def begin_command(self,command:str):
+        self.current_command=command
+    def flush_pending(self):
+        if self.pending is not None:
+            command,codes=self.pending
+            self.write_codes(self.output,codes,command)
+            self.pending=None
+    def emit(self,codes:list):
+        self.rom_size+=instruction_count(codes)
+        self.flush_pending()
+        self.pending=(self.current_command,list(codes))
+    def emit_tail(self,codes:list):
+        if len(codes) == 0:
+            return
+        self.rom_size+=instruction_count(codes)
+        if self.pending is None:
+            self.write_codes(self.output,codes)
+        else:
+            self.pending[1].extend(codes)
+    def save(self):
+        # 最后一条指令之后栈顶可能仍在D中，SP可能尚未写回
+        self.emit_tail(self.BlockExitCode())
+        self.flush_pending()
+        self.write_codes(self.output,self.SharedRoutines())
+        self.output.close()
+
     
+def translate_program(codeWriter,program:VMProgram,fuse_branch:bool=False,fuse_move:bool=False):
+    '''
+    翻译一个vm文件的全部指令，文件末尾写回D中缓存的栈顶与SP
+    '''
+    print("当前解析文件：",program.source_name)
+    label_prefix = program.source_name
+    codeWriter.set_current_vm_source(program.source_name)
+    opcodes=program.opcodes
+    operands=program.operands
+    # 操作码 -> 翻译函数，参数为指令下标
+    dispatch={
+        Opcode.PUSH:lambda index:codeWriter.writePush(program.segment_name(index),operands[index]),
+        Opcode.POP:lambda index:codeWriter.writePop(program.segment_name(index),operands[index]),
+        Opcode.LABEL:lambda index:codeWriter.writeLabel(label_prefix+'$'+program.name(index)),
+        Opcode.GOTO:lambda index:codeWriter.writeGoto(label_prefix+'$'+program.name(index)),
+        Opcode.IF_GOTO:lambda index:codeWriter.writeIf(label_prefix+'$'+program.name(index)),
+        Opcode.FUNCTION:lambda index:codeWriter.writeFunction(program.name(index),operands[index]),
+        Opcode.CALL:lambda index:codeWriter.writeCall(program.name(index),operands[index]),
+        Opcode.RETURN:lambda index:codeWriter.writeReturn(),
+    }
+    for opcode in [Opcode.ADD,Opcode.SUB,Opcode.NEG,Opcode.EQ,Opcode.GT,Opcode.LT,Opcode.AND,Opcode.OR,Opcode.NOT]:
+        dispatch[opcode]=lambda index:codeWriter.writeArithmetic(OPCODE_NAMES[opcodes[index]])
+    count=len(program)
+    index=0
+    while index < count:
+        opcode=opcodes[index]
+        if fuse_branch and opcode in COMPARE_OPCODES:
+            # 向后查看是否为 [not] if-goto
+            negate = index+1 < count and opcodes[index+1] == Opcode.NOT
+            branch_index = index+2 if negate else index+1
+            if branch_index < count and opcodes[branch_index] == Opcode.IF_GOTO:
+                codeWriter.begin_command('; '.join(program.command_text(i) for i in range(index,branch_index+1)))
+                codeWriter.writeCompareIf(OPCODE_NAMES[opcode],negate,label_prefix+'$'+program.name(branch_index))
+                index=branch_index+1
+                continue
+        if fuse_move and opcode == Opcode.PUSH and index+1 < count and opcodes[index+1] == Opcode.POP:
+            codeWriter.begin_command(program.command_text(index)+'; '+program.command_text(index+1))
+            codeWriter.writeMove(program.segment_name(index),operands[index],
+                                 program.segment_name(index+1),operands[index+1])
+            index+=2
+            continue
+        codeWriter.begin_command(program.command_text(index))
+        if opcode == Opcode.FUNCTION:
+            # label 的作用域是函数，同一文件中不同函数可以使用同名label
+            label_prefix = program.name(index)
+        dispatch[opcode](index)
+        index+=1
+    codeWriter.emit_tail(codeWriter.BlockExitCode())
+
+def translate_worker(output_filename:str,program:VMProgram,writer_options:dict,
+                     fuse_branch:bool,fuse_move:bool,cache_dir:str=None,cache_size:int=64*1024*1024):
+    '''
+    单独翻译一个vm文件（可在子进程中运行），返回 (翻译结果, 是否命中缓存)，
+    翻译结果见 CodeWriter.record，由主进程按文件顺序合并
+    '''
+    cache=None
+    if cache_dir is not None:
+        cache=TranslationCache(cache_dir,cache_size)
+        # 注释只影响写出，不影响翻译结果
+        options=sorted((name,value) for name,value in writer_options.items() if name != 'comments')
+        key=cache.key(program,repr((options,fuse_branch,fuse_move)))
+        record=cache.get(key,os.path.basename(output_filename)[:-4])
+        if record is not None:
+            return record,True
+    codeWriter=CodeWriter(output_filename,False,**writer_options)
+    translate_program(codeWriter,program,fuse_branch,fuse_move)
+    record=codeWriter.record()
+    if cache is not None:
+        cache.put(key,record,codeWriter.base_filename)
+    return record,False
+
 if __name__ == '__main__':
+    arg_parser=argparse.ArgumentParser(description='VM translator for Hack')
+    arg_parser.add_argument('input',help='Xxx.vm 或包含.vm文件的目录')
+    arg_parser.add_argument('--compact-calls',action='store_true',
+                            help='体积优化：call/return共用全局例程，调用处只传参并跳转')
+    arg_parser.add_argument('--shared-compare',action='store_true',
+                            help='体积优化：eq/lt/gt调用共享例程，不再每处内联')
+    arg_parser.add_argument('--fuse-branch',action='store_true',
+                            help='eq/lt/gt [not] if-goto 融合为一次条件跳转')
+    arg_parser.add_argument('--fuse-move',action='store_true',
+                            help='相邻的 push x; pop y 融合为直接传送，不经过栈')
+    arg_parser.add_argument('--cache-top',action='store_true',
+                            help='速度优化：栈顶缓存在D寄存器中，省去相邻指令间的存取')
+    arg_parser.add_argument('--static-sp',action='store_true',
+                            help='速度优化：基本块内相对SP快照寻址，只在块出口、调用、返回处写回SP')
+    arg_parser.add_argument('--optimize-for',choices=['speed','size'],default='speed',
+                            help='局部变量清零：speed总是展开，size在循环更短时使用循环')
+    arg_parser.add_argument('--keep-dead-functions',action='store_true',
+                            help='翻译目录时保留从Sys.init不可达的函数')
+    arg_parser.add_argument('--optimize-vm',action='store_true',
+                            help='翻译前先做VM层优化：常量折叠、死存储消除、不可达块删除、push/pop抵消')
+    arg_parser.add_argument('--stream',action='store_true',help='边翻译边写出，不在内存中保留全部汇编代码')
+    arg_parser.add_argument('--comments',choices=['full','compact','none'],default='full',
+                            help='输出注释：full为每条VM指令的起止注释与指令序号，compact只保留VM指令，none不写注释')
+    arg_parser.add_argument('--cache-dir',help='启用增量翻译，未变化的vm文件直接使用该目录下缓存的结果')
+    arg_parser.add_argument('--cache-size',type=int,default=64,help='缓存目录大小上限(MB)，超出时淘汰最久未使用的条目')
+    arg_parser.add_argument('-j','--jobs',type=int,default=1,help='并行翻译的进程数')
+    arg_parser.add_argument('--report',action='store_true',help='打印翻译统计')
+    args=arg_parser.parse_args()
     print('当前工作目录为：',os.getcwd())
-    input=os.getcwd() + '/'+sys.argv[1]
+    input=os.path.join(os.getcwd(),args.input)
     source_filenames=[]
     output_filename=''
     # 判断是否是目录，获取到所有后缀名为.vm的文件
     if os.path.isdir(input):
         if input.endswith('/'):
             input=input[:-1]
-        for filename in os.listdir(input):
+        # 排序保证输出顺序稳定
+        for filename in sorted(os.listdir(input)):
             if os.path.isfile(input+'/'+filename) and filename[-2:] == 'vm' :
                     source_filenames.append(input+'/'+filename)
         if len(source_filenames) == 0:
@@ -431,49 +1243,53 @@ if __name__ == '__main__':
         exit(1)
     print("输出目录为：",output_filename)
 
-    codeWriter = CodeWriter(output_filename,len(source_filenames)>1)
+    writer_options=dict(compact_calls=args.compact_calls,shared_compare=args.shared_compare,
+                        cache_top=args.cache_top,optimize_for=args.optimize_for,comments=args.comments,
+                        static_sp=args.static_sp)
+    writer_class = StreamingCodeWriter if args.stream else CodeWriter
+    codeWriter = writer_class(output_filename,len(source_filenames)>1,**writer_options)
     # 为目录下文件创建一个parser和codeWriter
     
-    commands = []
     for filename in source_filenames:
         assert filename[-2:] == 'vm','应输入名为Xxx.vm的文件'
-        print("当前解析文件：",filename)
-        vm_commands=[]
-        with open(filename,'r') as f:
-            for command in f:
-                command=command.strip()
-                if len(command)==0 or command[0]=='/':
-                    continue
-                if command.find('/') !=-1:
-                    command=command[:command.find('/')]
-                command=command.strip()
-                vm_commands.append(command)
-        label_prefix = os.path.basename(filename)[:-3]
-        codeWriter.set_current_vm_source(os.path.basename(filename)[:-3])
-        print('解析到的vm指令',vm_commands)
-        for command in vm_commands:
-            print(command + '->')
-            commands.append(command)
-            fields=command.split(' ')
-            if len(fields) == 1:
-                if fields[0] == 'return':
-                    codeWriter.writeReturn()
-                else:
-                    codeWriter.writeArithmetic(command)
-            elif command.startswith('push'):
-                codeWriter.writePush(fields[1],fields[2])
-            elif command.startswith('pop'):
-                codeWriter.writePop(fields[1],fields[2])
-            elif command.startswith('label'):
-                codeWriter.writeLabel(label_prefix+'$'+fields[1])
-            elif command.startswith('goto'):
-                codeWriter.writeGoto(label_prefix+'$'+fields[1])
-            elif command.startswith('if-goto'):
-                codeWriter.writeIf(label_prefix+'$'+fields[1])
-            elif command.startswith('function'):
-                codeWriter.writeFunction(fields[1],int(fields[2]))
-            elif command.startswith('call'):
-                codeWriter.writeCall(fields[1],int(fields[2]))
-            else:
-                raise ValueError('非法VM码')  
-    codeWriter.save(commands)    
+    removed_functions=[]
+    if len(source_filenames) > 1 and not args.keep_dead_functions:
+        programs,removed_functions=remove_dead_functions(
+            [parse_vm_file(filename) for filename in source_filenames])
+    else:
+        # 用到时才读取文件
+        programs=(parse_vm_file(filename) for filename in source_filenames)
+    optimizer=VMOptimizer()
+    if args.optimize_vm:
+        programs=(optimizer.optimize(program) for program in programs)
+
+    cache_hits=0
+    if args.jobs > 1 or args.cache_dir is not None:
+        # 各文件单独翻译后按顺序合并
+        programs=list(programs)
+        worker_args=([output_filename]*len(programs),programs,
+                     [writer_options]*len(programs),
+                     [args.fuse_branch]*len(programs),[args.fuse_move]*len(programs),
+                     [args.cache_dir]*len(programs),[args.cache_size*1024*1024]*len(programs))
+        if args.jobs > 1:
+            with ProcessPoolExecutor(args.jobs) as executor:
+                results=list(executor.map(translate_worker,*worker_args))
+        else:
+            results=map(translate_worker,*worker_args)
+        for record,cache_hit in results:
+            codeWriter.absorb(record)
+            cache_hits+=cache_hit
+    else:
+        for program in programs:
+            translate_program(codeWriter,program,args.fuse_branch,args.fuse_move)
+    codeWriter.save()
+    if args.report:
+        for line in codeWriter.report():
+            print(line)
+        if args.optimize_vm:
+            for line in optimizer.report():
+                print(line)
+        if len(removed_functions) > 0:
+            print('删除不可达函数: %d 个' % len(removed_functions))
+        if args.cache_dir is not None:
+            print('翻译缓存命中: %d/%d 个文件' % (cache_hits,len(programs)))    
@@ -0,0 +1,335 @@
+from array import array
+import argparse
+import json
+import struct
+import sys
+import os
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','06'))
+from assember import CodeTranslator, SymbolTable, pack_machine_codes, save_symbol_file, to_binary, unpack_machine_codes
+from VMTranslator import CodeWriter, RELOCATION_MARK, translate_program
+from vm_parser import Opcode, parse_vm_file
+
+
+# 目标文件格式变化时需要修改
+OBJECT_VERSION=2
+OBJECT_MAGIC=b'HOBJ'
+# 文件头：魔数、版本、符号表JSON的字节数、机器码的指令数，均为小端
+OBJECT_HEADER=struct.Struct('<4sHII')
+# 文件头之后的JSON中保存的字段，其后紧跟小端uint16机器码
+OBJECT_TABLE_FIELDS=['source','options','exports','relocations','imports','functions']
+
+
+def encode_object(source_name:str,asm_codes:list,options:dict=None,function_symbols:list=())->dict:
+    '''
+    将一个vm文件的汇编代码编码为目标文件
+    code: 小端uint16机器码，引用其他目标文件符号的A指令暂填0
+    exports: 本文件定义的标签 -> 相对地址
+    relocations: 引用本文件标签的A指令位置，链接时加上本文件的起始地址
+    imports: 未定义的符号 -> 引用它的A指令位置，链接时解析为其他文件的标签或分配为变量
+    functions: 函数入口符号列表，每个函数占据从入口到下一个函数入口的区间，链接时可整段删除
+    '''
+    codes=[code for command_codes in asm_codes for code in command_codes]
+    predefined=SymbolTable().table
+    exports={}
+    address=0
+    for code in codes:
+        if code.startswith('('):
+            assert code[1:-1] not in exports,'重复定义的标签'+code
+            exports[code[1:-1]]=address
+        else:
+            address+=1
+    c_command_table=CodeTranslator(SymbolTable(),False).c_command_table
+    machine_codes=array('H')
+    relocations=[]
+    imports={}
+    for code in codes:
+        if code.startswith('('):
+            continue
+        if code.startswith('@'):
+            symbol=code[1:]
+            if symbol.isdecimal():
+                machine_code=int(symbol)
+            elif symbol in predefined:
+                machine_code=predefined[symbol]
+            elif symbol in exports:
+                machine_code=exports[symbol]
+                relocations.append(len(machine_codes))
+            else:
+                machine_code=0
+                imports.setdefault(symbol,[]).append(len(machine_codes))
+        else:
+            machine_code=c_command_table.get(code)
+            assert machine_code is not None,'非法C指令'+code
+        machine_codes.append(machine_code)
+    return {
+        'version':OBJECT_VERSION,
+        'source':source_name,
+        'options':options or {},
+        'code':pack_machine_codes(machine_codes),
+        'exports':exports,
+        'relocations':relocations,
+        'imports':imports,
+        'functions':sorted(function_symbols,key=lambda symbol:exports[symbol]),
+    }
+
+def compile_object(filename:str,writer_options:dict=None,fuse_branch:bool=False,fuse_move:bool=False)->dict:
+    '''
+    翻译单个vm文件并编码为目标文件，符号以占位符代替输出文件名，可链接到任意程序中
+    '''
+    writer_options=writer_options or {}
+    codeWriter=CodeWriter(RELOCATION_MARK+'.asm',False,**writer_options)
+    program=parse_vm_file(filename)
+    translate_program(codeWriter,program,fuse_branch,fuse_move)
+    options=dict(writer_options,fuse_branch=fuse_branch,fuse_move=fuse_move)
+    function_symbols=[codeWriter.function_symbol(program.name(index))
+                      for index in range(len(program)) if program.opcodes[index] == Opcode.FUNCTION]
+    return encode_object(os.path.basename(filename),codeWriter.asm_codes,options,function_symbols)
+
+def save_object(file_path:str,hack_object:dict):
+    '''
+    目标文件格式：OBJECT_HEADER，UTF-8编码的JSON符号表，小端uint16机器码
+    '''
+    tables=json.dumps({field:hack_object[field] for field in OBJECT_TABLE_FIELDS}).encode()
+    with open(file_path,'wb') as f:
+        f.write(OBJECT_HEADER.pack(OBJECT_MAGIC,OBJECT_VERSION,len(tables),len(hack_object['code'])//2))
+        f.write(tables)
+        f.write(hack_object['code'])
+
+def load_object(file_path:str)->dict:
+    with open(file_path,'rb') as f:
+        data=f.read()
+    if len(data) < OBJECT_HEADER.size:
+        raise ValueError('不是Hack目标文件: '+file_path)
+    magic,version,tables_size,code_size=OBJECT_HEADER.unpack_from(data)
+    if magic != OBJECT_MAGIC:
+        raise ValueError('不是Hack目标文件: '+file_path)
+    if version != OBJECT_VERSION:
+        raise ValueError('目标文件版本不匹配: '+file_path)
+    code_start=OBJECT_HEADER.size+tables_size
+    if len(data) != code_start+code_size*2:
+        raise ValueError('目标文件长度不正确: '+file_path)
+    tables=json.loads(data[OBJECT_HEADER.size:code_start])
+    if set(tables) != set(OBJECT_TABLE_FIELDS):
+        raise ValueError('目标文件符号表不完整: '+file_path)
+    return dict(tables,version=version,code=data[code_start:])
+
+def function_sections(hack_object:dict)->list:
+    '''
+    返回 [(函数入口符号, 起始地址, 结束地址)]
+    '''
+    size=len(hack_object['code'])//2
+    starts=[hack_object['exports'][symbol] for symbol in hack_object['functions']]
+    return list(zip(hack_object['functions'],starts,starts[1:]+[size]))
+
+def reachable_functions(objects:list,entry:str)->set:
+    '''
+    从entry出发，沿A指令引用的函数符号（其他文件的导入或本文件的重定位）找出可达的函数
+    '''
+    # 函数入口符号 -> (目标文件, 起始地址, 结束地址)
+    sections={}
+    for hack_object in objects:
+        for symbol,start,end in function_sections(hack_object):
+            sections[symbol]=(hack_object,start,end)
+    reachable=set()
+    stack=[entry] if entry in sections else []
+    while len(stack) > 0:
+        symbol=stack.pop()
+        if symbol in reachable:
+            continue
+        reachable.add(symbol)
+        hack_object,start,end=sections[symbol]
+        referenced=[name for name,positions in hack_object['imports'].items()
+                    if any(start <= position < end for position in positions)]
+        codes=unpack_machine_codes(hack_object['code'])
+        for position in hack_object['relocations']:
+            if start <= position < end:
+                # 重定位的A指令引用本文件内的地址，找到该地址所在的函数
+                for name,section_start,section_end in function_sections(hack_object):
+                    if section_start <= codes[position] < section_end:
+                        referenced.append(name)
+        stack.extend(name for name in referenced if name in sections and name not in reachable)
+    return reachable
+
+def prune_object(hack_object:dict,reachable:set)->dict:
+    '''
+    删除不可达的函数区间，重新计算其余指令的地址
+    '''
+    removed=[(start,end) for symbol,start,end in function_sections(hack_object) if symbol not in reachable]
+    if len(removed) == 0:
+        return hack_object
+    codes=unpack_machine_codes(hack_object['code'])
+    # 旧地址 -> 新地址，被删除的为None；末尾多一项供指向文件末尾的标签使用
+    new_address=[]
+    removed_index=0
+    removed_size=0
+    for address in range(len(codes)+1):
+        while removed_index < len(removed) and removed[removed_index][1] <= address:
+            removed_size+=removed[removed_index][1]-removed[removed_index][0]
+            removed_index+=1
+        if removed_index < len(removed) and removed[removed_index][0] <= address:
+            new_address.append(None)
+        else:
+            new_address.append(address-removed_size)
+    machine_codes=array('H',(code for address,code in enumerate(codes) if new_address[address] is not None))
+    relocations=[]
+    for position in hack_object['relocations']:
+        if new_address[position] is not None:
+            assert new_address[codes[position]] is not None,'引用了被删除的函数'
+            machine_codes[new_address[position]]=new_address[codes[position]]
+            relocations.append(new_address[position])
+    imports={}
+    for symbol,positions in hack_object['imports'].items():
+        kept=[new_address[position] for position in positions if new_address[position] is not None]
+        if len(kept) > 0:
+            imports[symbol]=kept
+    exports={symbol:new_address[address] for symbol,address in hack_object['exports'].items()
+             if new_address[address] is not None}
+    return dict(hack_object,
+                code=pack_machine_codes(machine_codes),
+                exports=exports,
+                relocations=relocations,
+                imports=imports,
+                functions=[symbol for symbol in hack_object['functions'] if symbol in reachable])
+
+def is_static_variable(symbol:str)->bool:
+    '''
+    CodeWriter.static_variable_name 生成的符号：占位符$vm文件名$static$序号
+    '''
+    parts=symbol.split('$')
+    return len(parts) >= 4 and parts[0] == RELOCATION_MARK and parts[1] not in ('func','label','routine') \
+        and parts[-2] == 'static' and parts[-1].isdecimal()
+
+def runtime_objects(objects:list)->tuple:
+    '''
+    根据目标文件的符号生成引导代码与共享例程，返回 (放在最前的目标文件列表, 放在最后的目标文件列表)
+    '''
+    codeWriter=CodeWriter(RELOCATION_MARK+'.asm',True)
+    head=[]
+    if any(codeWriter.function_symbol('Sys.init') in hack_object['exports'] for hack_object in objects):
+        head.append(encode_object('bootstrap',[codeWriter.InitCode()]))
+    # 按各目标文件引用共享例程的次数设置计数，由 SharedRoutines 生成用到的例程
+    for hack_object in objects:
+        imports=hack_object['imports']
+        codeWriter.call_count+=len(imports.get(codeWriter.routine_symbol('call'),[]))
+        codeWriter.return_count+=len(imports.get(codeWriter.routine_symbol('return'),[]))
+        counts={command:len(imports[codeWriter.routine_symbol(command)]) for command in ['eq','lt','gt']
+                if codeWriter.routine_symbol(command) in imports}
+        if len(counts) > 0:
+            codeWriter.compare_counts[hack_object['source']]=counts
+    codeWriter.compact_calls=codeWriter.call_count > 0 or codeWriter.return_count > 0
+    codeWriter.shared_compare=len(codeWriter.compare_counts) > 0
+    tail=[]
+    routines=codeWriter.SharedRoutines()
+    if len(routines) > 0:
+        tail.append(encode_object('routines',[routines]))
+    return head,tail
+
+def link(objects:list,program_name:str='',remove_dead_functions:bool=True)->tuple:
+    '''
+    按顺序排布ROM：引导代码、各目标文件、共享例程；解析符号并修补地址
+    有Sys.init时默认删除从它不可达的函数
+    未被任何目标文件定义的静态变量按在ROM中首次出现的顺序从RAM 16开始分配，
+    其他未定义的符号（函数、标签等）引发ValueError
+    返回 (机器码 array('H'), 符号表 dict, 标签集合)，符号中的占位符替换为program_name
+    '''
+    entry=CodeWriter(RELOCATION_MARK+'.asm',False).function_symbol('Sys.init')
+    if remove_dead_functions and any(entry in hack_object['exports'] for hack_object in objects):
+        reachable=reachable_functions(objects,entry)
+        objects=[prune_object(hack_object,reachable) for hack_object in objects]
+    head,tail=runtime_objects(objects)
+    layout=head+list(objects)+tail
+    labels={}
+    base=0
+    bases=[]
+    for hack_object in layout:
+        bases.append(base)
+        for symbol,address in hack_object['exports'].items():
+            if symbol in labels:
+                raise ValueError('符号重复定义: '+symbol.replace(RELOCATION_MARK,program_name,1))
+            labels[symbol]=base+address
+        base+=len(hack_object['code'])//2
+    variables={}
+    symbol_table=SymbolTable()
+    machine_codes=array('H')
+    for hack_object,base in zip(layout,bases):
+        codes=unpack_machine_codes(hack_object['code'])
+        for position in hack_object['relocations']:
+            codes[position]+=base
+        # 按引用位置排序，保证变量按首次出现的顺序分配
+        references=sorted((position,symbol) for symbol,positions in hack_object['imports'].items()
+                          for position in positions)
+        for position,symbol in references:
+            if symbol in labels:
+                codes[position]=labels[symbol]
+            else:
+                if not is_static_variable(symbol):
+                    raise ValueError('未定义的符号: '+symbol.replace(RELOCATION_MARK,program_name,1))
+                if symbol not in variables:
+                    variables[symbol]=symbol_table.addEntry(symbol)
+                codes[position]=variables[symbol]
+        machine_codes.extend(codes)
+    assert all(code < 0x8000 for code in labels.values()),'ROM超过32K，A指令无法寻址'
+    table=dict(SymbolTable().table)
+    for symbol,address in list(labels.items())+list(variables.items()):
+        table[symbol.replace(RELOCATION_MARK,program_name,1)]=address
+    label_names=set(symbol.replace(RELOCATION_MARK,program_name,1) for symbol in labels)
+    return machine_codes,table,label_names
+
+
+if __name__ == '__main__':
+    arg_parser=argparse.ArgumentParser(description='Hack 目标文件与链接器')
+    subparsers=arg_parser.add_subparsers(dest='action',required=True)
+    compile_parser=subparsers.add_parser('compile',help='将vm文件翻译并编码为 Xxx.hobj')
+    compile_parser.add_argument('inputs',nargs='+',help='Xxx.vm 或包含.vm文件的目录')
+    compile_parser.add_argument('-o','--output-dir',help='目标文件输出目录，默认与vm文件相同')
+    compile_parser.add_argument('--compact-calls',action='store_true')
+    compile_parser.add_argument('--shared-compare',action='store_true')
+    compile_parser.add_argument('--fuse-branch',action='store_true')
+    compile_parser.add_argument('--fuse-move',action='store_true')
+    compile_parser.add_argument('--cache-top',action='store_true')
+    compile_parser.add_argument('--static-sp',action='store_true')
+    compile_parser.add_argument('--optimize-for',choices=['speed','size'],default='speed')
+    link_parser=subparsers.add_parser('link',help='链接目标文件，输出 .hack 或 .hackb')
+    link_parser.add_argument('objects',nargs='+',help='Xxx.hobj 或包含.hobj文件的目录')
+    link_parser.add_argument('-o','--output',required=True,help='Xxx.hack 或 Xxx.hackb')
+    link_parser.add_argument('--symbols',action='store_true',help='同时写出符号表 Xxx.sym')
+    link_parser.add_argument('--keep-dead-functions',action='store_true',help='保留从Sys.init不可达的函数')
+    args=arg_parser.parse_args()
+
+    def expand(paths:list,suffix:str)->list:
+        file_paths=[]
+        for path in paths:
+            if os.path.isdir(path):
+                file_paths.extend(os.path.join(path,filename) for filename in sorted(os.listdir(path))
+                                  if filename.endswith(suffix))
+            else:
+                file_paths.append(path)
+        return file_paths
+
+    if args.action == 'compile':
+        writer_options=dict(compact_calls=args.compact_calls,shared_compare=args.shared_compare,
+                            cache_top=args.cache_top,optimize_for=args.optimize_for,static_sp=args.static_sp)
+        for filename in expand(args.inputs,'.vm'):
+            hack_object=compile_object(filename,writer_options,args.fuse_branch,args.fuse_move)
+            output_dir=args.output_dir if args.output_dir is not None else os.path.dirname(filename)
+            object_path=os.path.join(output_dir,os.path.basename(filename)[:-3]+'.hobj')
+            save_object(object_path,hack_object)
+            print('%s -> %s: %d 条指令, 导出 %d, 导入 %d, 重定位 %d' % (
+                filename,object_path,len(hack_object['code'])//2,len(hack_object['exports']),
+                len(hack_object['imports']),len(hack_object['relocations'])))
+    else:
+        objects=[load_object(file_path) for file_path in expand(args.objects,'.hobj')]
+        base_path=args.output[:args.output.rfind('.')]
+        machine_codes,table,labels=link(objects,os.path.basename(base_path),not args.keep_dead_functions)
+        if args.output.endswith('.hackb'):
+            with open(args.output,'wb') as f:
+                f.write(pack_machine_codes(machine_codes))
+        else:
+            with open(args.output,'w') as f:
+                for machine_code in machine_codes:
+                    f.write(to_binary(machine_code))
+                    f.write('\n')
+        if args.symbols:
+            save_symbol_file(base_path+'.sym',table,labels)
+        print('链接 %d 个目标文件 -> %s: %d 条指令' % (len(objects),args.output,len(machine_codes)))
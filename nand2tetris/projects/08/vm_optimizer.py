@@ -0,0 +1,297 @@
+import argparse
+import sys
+import os
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','07'))
+from vm_parser import Opcode, Segment, VMProgram, parse_vm_file
+
+
+BINARY_OPCODES=frozenset([Opcode.ADD,Opcode.SUB,Opcode.AND,Opcode.OR,Opcode.EQ,Opcode.GT,Opcode.LT])
+UNARY_OPCODES=frozenset([Opcode.NEG,Opcode.NOT])
+# 死存储分析跟踪的段，this/that 经指针访问，可能与任何地址重叠，不跟踪
+TRACKED_SEGMENTS=frozenset([Segment.LOCAL,Segment.ARGUMENT,Segment.TEMP,Segment.STATIC,Segment.POINTER])
+# 函数返回后不再可见的段
+FRAME_SEGMENTS=frozenset([Segment.LOCAL,Segment.ARGUMENT])
+
+
+def to_signed(value:int)->int:
+    value&=0xFFFF
+    return value-0x10000 if value & 0x8000 else value
+
+def fold_binary(opcode:Opcode,x:int,y:int)->int:
+    '''
+    与Hack上16位补码运算结果一致，比较结果为 -1/0
+    '''
+    if opcode == Opcode.ADD:
+        return to_signed(x+y)
+    if opcode == Opcode.SUB:
+        return to_signed(x-y)
+    if opcode == Opcode.AND:
+        return to_signed(x&y)
+    if opcode == Opcode.OR:
+        return to_signed(x|y)
+    # 与翻译器相同，比较的是 x-y 的16位结果
+    difference=to_signed(x-y)
+    if opcode == Opcode.EQ:
+        return -1 if difference == 0 else 0
+    if opcode == Opcode.GT:
+        return -1 if difference > 0 else 0
+    return -1 if difference < 0 else 0
+
+def constant_commands(value:int)->list:
+    '''
+    生成压入value的指令，push constant 只能表示 0..32767
+    '''
+    if 0 <= value < 0x8000:
+        return [(Opcode.PUSH,Segment.CONSTANT,value,None)]
+    if value == -1:
+        return [(Opcode.PUSH,Segment.CONSTANT,0,None),(Opcode.NOT,Segment.NONE,0,None)]
+    return None
+
+def is_constant(command:tuple)->bool:
+    return command[0] == Opcode.PUSH and command[1] == Segment.CONSTANT
+
+
+class BasicBlock:
+    def __init__(self,start:int,end:int) -> None:
+        # 在函数指令列表中的区间 [start, end)
+        self.start=start
+        self.end=end
+        self.successors=[]
+
+
+class VMOptimizer:
+    '''
+    VM到VM的优化：按function划分，构建基本块与控制流图，依次执行各个优化，直到不再变化
+    统计每个优化删除的指令数
+    '''
+    passes=['unreachable_blocks','constant_folding','push_pop_cancel','dead_stores']
+    def __init__(self) -> None:
+        self.removed={name:0 for name in self.passes}
+        self.commands_before=0
+        self.commands_after=0
+
+    def optimize(self,program:VMProgram)->VMProgram:
+        commands=[(program.opcodes[index],program.segments[index],program.operands[index],
+                   None if program.symbols[index] < 0 else program.names[program.symbols[index]])
+                  for index in range(len(program))]
+        self.commands_before+=len(commands)
+        # 每个function到下一个function之前为一个函数，文件开头function之前的指令单独为一段
+        starts=[index for index,command in enumerate(commands) if command[0] == Opcode.FUNCTION]
+        if len(starts) == 0 or starts[0] != 0:
+            starts.insert(0,0)
+        result=VMProgram(program.source_name)
+        for start,end in zip(starts,starts[1:]+[len(commands)]):
+            for opcode,segment,operand,name in self.optimize_function(commands[start:end]):
+                result.append(opcode,segment,operand,name)
+        self.commands_after+=len(result)
+        return result
+
+    def optimize_function(self,commands:list)->list:
+        for _ in range(16):
+            size=len(commands)
+            for name in self.passes:
+                before=len(commands)
+                commands=getattr(self,name)(commands)
+                self.removed[name]+=before-len(commands)
+            if len(commands) == size:
+                break
+        return commands
+
+    def build_blocks(self,commands:list)->list:
+        '''
+        标签处与跳转、返回之后开始新的基本块，并按跳转目标与顺序执行连接后继
+        '''
+        leaders=set([0])
+        for index,(opcode,_,_,_) in enumerate(commands):
+            if opcode == Opcode.LABEL:
+                leaders.add(index)
+            elif opcode in (Opcode.GOTO,Opcode.IF_GOTO,Opcode.RETURN):
+                leaders.add(index+1)
+        leaders=sorted(leader for leader in leaders if leader < len(commands))
+        blocks=[BasicBlock(start,end) for start,end in zip(leaders,leaders[1:]+[len(commands)])]
+        label_blocks={}
+        for block_index,block in enumerate(blocks):
+            if commands[block.start][0] == Opcode.LABEL:
+                label_blocks[commands[block.start][3]]=block_index
+        for block_index,block in enumerate(blocks):
+            opcode,_,_,name=commands[block.end-1]
+            if opcode in (Opcode.GOTO,Opcode.IF_GOTO):
+                assert name in label_blocks,'跳转目标不存在: '+name
+                block.successors.append(label_blocks[name])
+            if opcode not in (Opcode.GOTO,Opcode.RETURN) and block_index+1 < len(blocks):
+                block.successors.append(block_index+1)
+        return blocks
+
+    def unreachable_blocks(self,commands:list)->list:
+        if len(commands) == 0:
+            return commands
+        blocks=self.build_blocks(commands)
+        reachable=set([0])
+        stack=[0]
+        while len(stack) > 0:
+            for successor in blocks[stack.pop()].successors:
+                if successor not in reachable:
+                    reachable.add(successor)
+                    stack.append(successor)
+        if len(reachable) == len(blocks):
+            return commands
+        result=[]
+        for block_index,block in enumerate(blocks):
+            if block_index in reachable:
+                result.extend(commands[block.start:block.end])
+        return result
+
+    def constant_folding(self,commands:list)->list:
+        '''
+        常量运算折叠，以及 x+0、x-0、x|0、not not、neg neg 等恒等式
+        相邻的指令之间没有标签，不会有其他位置跳入
+        '''
+        result=[]
+        for command in commands:
+            result.append(command)
+            while self.fold_tail(result):
+                pass
+        return result
+
+    def fold_tail(self,result:list)->bool:
+        if len(result) >= 2 and result[-1][0] in UNARY_OPCODES and result[-2][0] == result[-1][0]:
+            del result[-2:]
+            return True
+        if len(result) >= 2 and result[-1][0] in (Opcode.ADD,Opcode.SUB,Opcode.OR) \
+                and is_constant(result[-2]) and result[-2][2] == 0:
+            del result[-2:]
+            return True
+        if len(result) >= 3 and result[-1][0] in BINARY_OPCODES and is_constant(result[-2]) and is_constant(result[-3]):
+            folded=constant_commands(fold_binary(result[-1][0],result[-3][2],result[-2][2]))
+            if folded is not None:
+                result[-3:]=folded
+                return True
+        if len(result) >= 2 and result[-1][0] == Opcode.NEG and is_constant(result[-2]) and result[-2][2] == 0:
+            del result[-1]
+            return True
+        # 条件为常量的跳转：为假时删除，为真时改为goto，之后的不可达块由 unreachable_blocks 删除
+        if len(result) >= 2 and result[-1][0] == Opcode.IF_GOTO and is_constant(result[-2]):
+            jump=result[-2][2] != 0
+            target=result[-1][3]
+            del result[-2:]
+            if jump:
+                result.append((Opcode.GOTO,Segment.NONE,0,target))
+            return True
+        if len(result) >= 3 and result[-1][0] == Opcode.IF_GOTO and result[-2][0] == Opcode.NOT \
+                and is_constant(result[-3]):
+            # 0..32767 取反后都不为0
+            result[-3:]=[(Opcode.GOTO,Segment.NONE,0,result[-1][3])]
+            return True
+        return False
+
+    def push_pop_cancel(self,commands:list)->list:
+        '''
+        push x; pop x 不改变任何状态
+        '''
+        result=[]
+        for command in commands:
+            if command[0] == Opcode.POP and len(result) > 0 and result[-1][0] == Opcode.PUSH \
+                    and result[-1][1:3] == command[1:3]:
+                result.pop()
+                continue
+            result.append(command)
+        return result
+
+    def dead_stores(self,commands:list)->list:
+        '''
+        基本块内，pop到某个位置后、读取之前又被覆盖，或函数返回前不再读取的局部变量/参数，
+        如果值来自无副作用的push与运算，连同计算过程一起删除
+        '''
+        if len(commands) == 0:
+            return commands
+        frame_slots=set((command[1],command[2]) for command in commands
+                        if command[0] in (Opcode.PUSH,Opcode.POP) and command[1] in FRAME_SEGMENTS)
+        dead=[]
+        for block in self.build_blocks(commands):
+            # 在之后被覆盖且中间不会被读取的位置
+            overwritten=set()
+            for index in range(block.end-1,block.start-1,-1):
+                opcode,segment,operand,_=commands[index]
+                slot=(segment,operand)
+                if opcode == Opcode.RETURN:
+                    overwritten.update(frame_slots)
+                elif opcode == Opcode.POP and segment in TRACKED_SEGMENTS:
+                    if slot in overwritten:
+                        dead.append(index)
+                    overwritten.add(slot)
+                elif opcode == Opcode.POP and segment in (Segment.THIS,Segment.THAT):
+                    # 读取了 pointer 0/1
+                    overwritten.discard((Segment.POINTER,segment-Segment.THIS))
+                elif opcode == Opcode.PUSH and segment in TRACKED_SEGMENTS:
+                    overwritten.discard(slot)
+                elif (opcode == Opcode.PUSH and segment in (Segment.THIS,Segment.THAT)) or opcode == Opcode.CALL:
+                    # 经指针读取或调用其他函数，可能读到任何位置
+                    overwritten.clear()
+        removed=set()
+        for index in dead:
+            start=self.expression_start(commands,index)
+            if start is not None:
+                removed.update(range(start,index+1))
+        if len(removed) == 0:
+            return commands
+        return [command for index,command in enumerate(commands) if index not in removed]
+
+    def expression_start(self,commands:list,index:int):
+        '''
+        向前找到产生 commands[index] 所出栈的值、且无副作用的指令序列的起点，找不到时返回None
+        '''
+        needed=1
+        for start in range(index-1,-1,-1):
+            opcode=commands[start][0]
+            if opcode == Opcode.PUSH:
+                needed-=1
+            elif opcode in BINARY_OPCODES:
+                needed+=1
+            elif opcode not in UNARY_OPCODES:
+                return None
+            if needed == 0:
+                return start
+        return None
+
+    def report(self)->list:
+        lines=['VM指令: %d -> %d' % (self.commands_before,self.commands_after)]
+        for name in self.passes:
+            lines.append('%s: 删除 %d 条指令' % (name,self.removed[name]))
+        return lines
+
+
+def write_vm_file(filename:str,program:VMProgram):
+    with open(filename,'w') as f:
+        for index in range(len(program)):
+            f.write(program.command_text(index))
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    arg_parser=argparse.ArgumentParser(description='VM optimizer，可用于 jack_parser.py 与 VMTranslator.py 之间')
+    arg_parser.add_argument('inputs',nargs='+',help='Xxx.vm 或包含.vm文件的目录')
+    output_group=arg_parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument('-o','--output-dir',help='优化后的vm文件写入该目录，文件名不变')
+    output_group.add_argument('--in-place',action='store_true',help='直接覆盖原文件')
+    arg_parser.add_argument('--report',action='store_true',help='打印各个优化删除的指令数')
+    args=arg_parser.parse_args()
+
+    filenames=[]
+    for path in args.inputs:
+        if os.path.isdir(path):
+            filenames.extend(os.path.join(path,filename) for filename in sorted(os.listdir(path))
+                             if filename.endswith('.vm'))
+        else:
+            filenames.append(path)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir,exist_ok=True)
+    optimizer=VMOptimizer()
+    for filename in filenames:
+        program=optimizer.optimize(parse_vm_file(filename))
+        output_filename=filename if args.in_place else os.path.join(args.output_dir,os.path.basename(filename))
+        write_vm_file(output_filename,program)
+        print(filename,'->',output_filename)
+    if args.report:
+        for line in optimizer.report():
+            print(line)